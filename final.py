@@ -1,46 +1,527 @@
 #from typing import Protocol
 import boto3
 import os
-import paramiko
+import csv
 import time
-import requests
-from datetime import datetime, timedelta
-from matplotlib import pyplot as plt
+import math
+import socket
+import subprocess
+import sys
+import shutil
+import tarfile
+import hashlib
+import json
+import sqlite3
+import threading
+import importlib
+import warnings
+import argparse
+import multiprocessing
+import http.client
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import cycle, islice
+from fnmatch import fnmatchcase
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+
+
+class LazyModule:
+    """
+    Stand-in for a module which is only imported the first time one of its attributes is used
+
+    Keeps the heavy dependencies out of the start-up of the phases that never use them.
+    """
 
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+np = LazyModule('numpy')
+paramiko = LazyModule('paramiko')
+requests = LazyModule('requests')
+
+# instance type and number of instances of every cluster, each gets its own target group and listener rule
+CLUSTERS = {'cluster1': ('t2.micro', 2), 'cluster2': ('t2.micro', 2)}
+LOAD_BALANCER_NAME = 'LoadBalancerOne'
+SUBNETS = ['subnet-03c5c7430a5220718', 'subnet-0ea8ee263c594b48c',
+           'subnet-05b40d02f69eb368a', 'subnet-0b43452ba329ed175',
+           'subnet-0c5bb5c903b5dbd9d', 'subnet-04159a4fcc1d12324']
+# file recording the deployed resources and the completed phases between runs
+STATE_PATH = 'tp1_state.json'
+# maximum number of requests in flight per scenario during the load test
+DEFAULT_CONCURRENCY = 32
+# number of processes the load test is sharded across
+LOAD_PROCESSES = 1
+# latency percentiles shown in the load test report
+REPORT_PERCENTILES = (50, 90, 99, 99.9)
+# append-only CSV file receiving one line per request sent during the load test
+RESULTS_PATH = 'load_test_results.csv'
+# number of results buffered before they are written to RESULTS_PATH
+RESULTS_BATCH_SIZE = 1000
+# number of seconds between two redraws of the live telemetry line
+PROGRESS_INTERVAL = 1.0
+# length in seconds of the sliding window the live telemetry is computed over
+TELEMETRY_WINDOW = 10
+# local port the live telemetry is served on as JSON during the load test, 0 to disable
+TELEMETRY_PORT = 8089
+# address the live telemetry listens on, 0.0.0.0 to reach it from outside a container
+TELEMETRY_HOST = '127.0.0.1'
+# keys of the Flask app response that identify the instance which served the request
+INSTANCE_ID_KEYS = ('instance_id', 'instance', 'InstanceId')
+# target the responses without any of INSTANCE_ID_KEYS are attributed to
+UNKNOWN_INSTANCE = 'unknown'
+# seconds the offline benchmark sends requests back to back to every cluster
+BENCHMARK_DURATION = 10
+# requests per second of the benchmark timetable, far above what the stand-ins answer so that only
+# the sending threads limit the rate
+BENCHMARK_MAX_RATE = 100000
+BENCHMARK_RESULTS_PATH = 'benchmark_results.csv'
+BENCHMARK_BASELINE_PATH = 'benchmark_baseline.json'
+# the benchmark fails when its throughput is more than this fraction below the baseline
+BENCHMARK_TOLERANCE = 0.2
+# a target is flagged when its share of the requests deviates from an even split by more than this fraction
+TARGET_IMBALANCE_THRESHOLD = 0.25
+# a cluster is flagged as sticky when more consecutive responses than this come from the same target
+TARGET_STICKY_THRESHOLD = 0.9
+# a target is flagged as slow when its median latency is this many times the cluster's
+TARGET_SLOW_FACTOR = 1.5
+# attempts of an AWS call (first one included), the clients back off adaptively between them
+AWS_RETRIES = 8
+AWS_REGION = 'us-east-1'
+# connections kept open per AWS client, enough for every thread of the bootstrap and metrics pools
+AWS_MAX_POOL_CONNECTIONS = 32
+# private key used to log into the instances, next to this script so that it is found from any working directory
+KEY_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ec2-keypair.pem')
+SSH_USERNAME = 'ubuntu'
+# seconds to wait for the SSH port of a new instance to open
+SSH_READY_TIMEOUT = 300
+# attempts at opening an SSH session once the port is open
+SSH_CONNECT_RETRIES = 5
+# maximum number of instances bootstrapped at the same time
+BOOTSTRAP_WORKERS = 16
+# sources of the Flask app deployed on every instance
+APP_REPOSITORY = 'https://github.com/CommissarSilver/cloud-computing-tp1.git'
+# install flask and deploy a simple script on each instance, the last command keeps running
+# every command can run again on a host which was already bootstrapped
+BOOTSTRAP_COMMANDS = ['sudo apt-get update',
+                      'yes | sudo apt install python3-pip',
+                      'sudo pip install Flask',
+                      f'test -d cloud-computing-tp1 || git clone "{APP_REPOSITORY}"',
+                      # pgrep -f would match this command line too, the app is tracked by its pid file
+                      'test -d /proc/"$(cat ~/hello.pid 2>/dev/null || echo 0)" || (cd cloud-computing-tp1 && '
+                      '{ sudo nohup python3 hello.py > hello.log 2>&1 & echo $! > ~/hello.pid; })']
+# directory the bootstrap bundle (wheels and app sources) is built in on the control machine
+BUNDLE_DIR = 'bootstrap_bundle'
+BUNDLE_REQUIREMENTS = ['Flask']
+# platform and Python version of the Ubuntu Server image the wheels are downloaded for
+TARGET_PLATFORM = 'manylinux2014_x86_64'
+TARGET_PYTHON_VERSION = '38'
+# seconds to wait for every registered target to pass its health checks
+HEALTH_TIMEOUT = 600
+# seconds of CloudWatch metrics fetched after the test, and seconds aggregated in one datapoint
+METRICS_WINDOW = 1200
+METRICS_PERIOD = 60
+# limits of one GetMetricData call
+MAX_METRIC_QUERIES = 500
+MAX_METRIC_DATAPOINTS = 100800
+# maximum number of GetMetricData calls in flight
+METRICS_WORKERS = 4
+# SQLite file caching the CloudWatch datapoints between runs
+METRICS_CACHE_PATH = 'metrics_cache.sqlite'
+# seconds CloudWatch may take to ingest a datapoint, more recent ranges are fetched again next time
+METRICS_CACHE_LAG = 600
+# charts of the report: PNG file -> (metric, label) pairs drawn on it
+REPORT_CHARTS = [
+    ('EB_Request_Count_demo.png', [('load_balancer_request_counts_sum', 'Load Balancer Request Counts - Sum')]),
+    ('Active_Conn_Count_demo.png', [('active_connection_counts_sum', 'Active Connection Counts - Sum')]),
+    ('New_Conn_Count_demo.png', [('new_connection_counts_sum', 'New Connection Counts - Sum')]),
+    ('Rule_Eva_Count_demo.png', [('rule_evaluations_counts_sum', 'Rule Evaluation Counts - Sum')]),
+    ('LB_Resp_T_demo.png', [('target_response_time_sum', 'Load Balancer Target Response Time - Sum')]),
+    ('Cluster_Avg_T_demo.png', [('cluster1_target_response_time_avg', 'Cluster 1 Target Response Time - Average'),
+                                ('cluster2_target_response_time_avg', 'Cluster 2 Target Response Time - Average')]),
+    ('Cluster_Avg_Sum_demo.png',
+     [('cluster1_target_request_time_per_counter_sum', 'Cluster 1 Target Request Time Per Counter - Sum'),
+      ('cluster2_target_request_time_per_counter_sum', 'Cluster 2 Target Request Time Per Counter - Sum')]),
+    ('Cluster_Req_Per_Target_demo.png',
+     [('cluster1_requests_per_target_per_second', 'Cluster 1 Requests Per Target Per Second'),
+      ('cluster2_requests_per_target_per_second', 'Cluster 2 Requests Per Target Per Second')]),
+    ('Cluster_Latency_Ratio_demo.png',
+     [('cluster_latency_ratio', 'Cluster 1 / Cluster 2 Target Response Time - Average')]),
+]
+# number of processes rendering the charts
+REPORT_PROCESSES = 4
+# number of sweep cells provisioned and tested at the same time
+SWEEP_WORKERS = 4
+# on-demand vCPUs the sweep may use at once when the EC2 quota can not be read
+SWEEP_VCPU_BUDGET = 32
+# the sweep results are split into windows of this many seconds of send time to find the saturation point
+SWEEP_WINDOW = 10
+# a window is saturated when its p99 latency (seconds) or its error rate exceed these
+SWEEP_LATENCY_SLO = 0.5
+SWEEP_MAX_ERROR_RATE = 0.01
+# path the sweep cells are tested on, the app only answers on the cluster paths
+SWEEP_PATH = 'cluster1'
+SWEEP_REPORT_PATH = 'sweep_report.csv'
+# on-demand Linux price in us-east-1 (USD per hour), the sweep matrix may add or override prices
+INSTANCE_PRICES = {
+    't2.micro': 0.0116, 't2.small': 0.023, 't2.medium': 0.0464, 't2.large': 0.0928, 't2.xlarge': 0.1856,
+    't3.micro': 0.0104, 't3.small': 0.0208, 't3.medium': 0.0416, 't3.large': 0.0832, 't3.xlarge': 0.1664,
+    'm5.large': 0.096, 'm5.xlarge': 0.192, 'c5.large': 0.085, 'c5.xlarge': 0.17,
+}
+
+
+class Tracer:
+    """
+    Records nested, timed spans of a run: phases, AWS API calls, bootstrap steps and load test scenarios
 
-def create_instance(instance_type: str, number_of_instance=1):
+    Every thread keeps its own stack of open spans, so a span started inside another one on the same
+    thread becomes its child; functions run on other threads keep the span they were submitted from as
+    parent when wrapped with wrap(). Nothing is recorded until the tracer is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.last_id = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        """
+        Returns the id of the innermost open span of the calling thread, or None
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _new_id(self):
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def _record(self, span_id, name, parent, start, end, attributes, error=None):
+        thread = threading.current_thread()
+        with self.lock:
+            self.spans.append({'id': span_id, 'parent': parent, 'name': name, 'start': start, 'end': end,
+                               'process': os.getpid(), 'thread': thread.ident, 'thread_name': thread.name,
+                               'attributes': attributes, 'error': error})
+
+    def reset(self, enabled):
+        """
+        Forgets every span and open span, like a new tracer: a forked worker process inherits the
+        spans and the stack of its parent
+        """
+        with self.lock:
+            self.enabled = enabled
+            self.spans = []
+            self.local = threading.local()
+
+    def adopt(self, spans, parent=None):
+        """
+        Adds spans recorded by another tracer (a worker process), their roots becoming children of {parent}
+
+        Args:
+            spans ([list]): [spans of the other tracer]
+            parent (int, optional): [id of the span they are part of]. Defaults to the current span.
+        """
+        parent = self.current() if parent is None else parent
+        ids = {span['id']: self._new_id() for span in spans}
+        with self.lock:
+            self.spans += [dict(span, id=ids[span['id']], parent=ids.get(span['parent'], parent)) for span in spans]
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the enclosed block as a child of the current span
+
+        Args:
+            name ([str]): [name of the span]
+            attributes : [JSON-serializable attributes, like instance_id or command]
+
+        Yields:
+            [dict]: [the attributes of the span, which can still be added to]
+        """
+        if not self.enabled:
+            yield attributes
+            return
+        span_id = self._new_id()
+        parent = self.current()
+        stack = self._stack()
+        stack.append(span_id)
+        start = time.time()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            stack.pop()
+            self._record(span_id, name, parent, start, time.time(), attributes, error)
+
+    def wrap(self, function):
+        """
+        Returns {function} running as a child of the current span, whichever thread calls it
+        """
+        parent = self.current()
+
+        def wrapped(*args, **kwargs):
+            stack = self._stack()
+            stack.append(parent)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapped
+
+    def before_aws_call(self, params=None, model=None, context=None, **kwargs):
+        # botocore event handlers, the span of an API call (retries included) is recorded once it returned
+        # or failed; they must never raise, or their error would replace the one of the call
+        if not self.enabled or context is None:
+            return
+        try:
+            context['trace'] = (self.current(), time.time(), model.service_model.service_name, model.name,
+                                (params or {}).get('InstanceIds'))
+        except Exception:
+            pass
+
+    def after_aws_call(self, context=None, parsed=None, exception=None, **kwargs):
+        if not self.enabled or not context or 'trace' not in context:
+            return
+        try:
+            parent, start, service, operation, instance_ids = context.pop('trace')
+            attributes = {'service': service, 'operation': operation}
+            if instance_ids:
+                attributes['instance_ids'] = list(instance_ids)
+            metadata = (parsed or {}).get('ResponseMetadata', {})
+            if metadata:
+                attributes['status'] = metadata.get('HTTPStatusCode')
+                attributes['retries'] = metadata.get('RetryAttempts', 0)
+            error = (parsed or {}).get('Error', {}).get('Code') or \
+                (exception is not None and f'{type(exception).__name__}: {exception}')
+            self._record(self._new_id(), f'aws {service}.{operation}', parent, start, time.time(),
+                         attributes, error or None)
+        except Exception:
+            pass
+
+    def critical_path(self, span_id=None):
+        """
+        Returns the spans which determined when a span ended: going back from its end, the child which
+        ended last, then the child which ended last before that one started, and so on, each of them
+        expanded the same way
+
+        Args:
+            span_id (int, optional): [id of the span]. Defaults to the root span which ended last.
+
+        Returns:
+            [list]: [(depth, span) pairs, in time order]
+        """
+        with self.lock:
+            spans = list(self.spans)
+        children = {}
+        for span in spans:
+            children.setdefault(span['parent'], []).append(span)
+        roots = children.get(None, [])
+        if span_id is None and not roots:
+            return []
+        root = max(roots, key=lambda s: s['end']) if span_id is None else \
+            next(span for span in spans if span['id'] == span_id)
+
+        path = []
+
+        def expand(span, depth):
+            path.append((depth, span))
+            chain = []
+            end = span['end']
+            while True:
+                before = [child for child in children.get(span['id'], []) if child['end'] <= end]
+                if not before:
+                    break
+                chain.append(max(before, key=lambda child: child['end']))
+                end = chain[-1]['start']
+            for child in reversed(chain):
+                expand(child, depth + 1)
+
+        expand(root, 0)
+        return path
+
+    def export(self, path):
+        """
+        Writes the recorded spans to {path}: a Chrome trace (chrome://tracing, Perfetto) when it ends
+        with .json, one JSON object per span otherwise
+
+        Args:
+            path ([str]): [output file]
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        with open(path, 'w') as f:
+            if not path.endswith('.json'):
+                for span in spans:
+                    f.write(json.dumps(dict(span, duration=span['end'] - span['start'])) + '\n')
+                return
+            events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread, 'args': {'name': name}}
+                      for (pid, thread), name in {(span['process'], span['thread']): span['thread_name']
+                                                  for span in spans}.items()]
+            for span in spans:
+                args = dict(span['attributes'], id=span['id'], parent=span['parent'])
+                if span['error']:
+                    args['error'] = span['error']
+                events.append({'name': span['name'], 'cat': span['name'].split()[0], 'ph': 'X',
+                               'pid': span['process'],
+                               'tid': span['thread'], 'ts': span['start'] * 1e6,
+                               'dur': (span['end'] - span['start']) * 1e6, 'args': args})
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# spans of the current run, enabled by --trace
+TRACER = Tracer()
+
+
+# AWS clients shared by every call, created on first use
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+
+
+def aws_client(service, region=AWS_REGION):
+    """
+    Returns the shared client of an AWS service, creating it the first time it is needed
+
+    Clients are thread-safe and costly to build, so one client per (service, region) is reused by
+    every call. They keep a larger connection pool and retry throttled calls adaptively, and every
+    API call they make is recorded as a span by TRACER.
+
+    Args:
+        service ([str]): [AWS service name, like 'ec2' or 'elbv2']
+        region (str, optional): [AWS region]. Defaults to AWS_REGION.
+
+    Returns:
+        [botocore client]
+    """
+    key = (service, region)
+    client = _aws_clients.get(key)
+    if client is None:
+        # building clients from the default boto3 session is not thread-safe
+        with _aws_clients_lock:
+            client = _aws_clients.get(key)
+            if client is None:
+                client = _aws_clients[key] = boto3.client(
+                    service, region_name=region,
+                    config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                                  retries={'max_attempts': AWS_RETRIES, 'mode': 'adaptive'}))
+                client.meta.events.register('before-parameter-build', TRACER.before_aws_call)
+                client.meta.events.register('after-call', TRACER.after_aws_call)
+                client.meta.events.register('after-call-error', TRACER.after_aws_call)
+    return client
+
+
+def create_instance(instance_type: str, number_of_instance=1, ec2_client=None, wait=True):
     """
     Creates {number_of_instance} EC2 instances based on the given instance type 
 
     Args:
         instance_type ([string]): [instance image id]
         number_of_instance (int, optional): [number of copies of instance]. Defaults to 1.
+        ec2_client (optional): [EC2 client to use]. Defaults to the shared client.
+        wait (bool, optional): [wait until the instances are running]. Defaults to True.
 
     Returns:
         [ec2.instance]: [an EC2 instance object which contains information about the instances]
     """
 
     # create a new EC2 instance
-    ec2 = boto3.client('ec2', region_name='us-east-1')
-
-    instances = ec2.run_instances(
-        ImageId='ami-09e67e426f25ce0d7',  # Ubuntu Server image
-        MinCount=1,
-        MaxCount=number_of_instance,
-        InstanceType=instance_type,
-        KeyName='ec2-keypair'  # key-pair value
-    )
-
-    ec2 = boto3.resource('ec2')
-    for instance in instances['Instances']:
-        instance_ = ec2.Instance(id=instance['InstanceId'])
-        instance_.wait_until_running()  # wait until the instance is up and running
-        print(
-            f"--> Instance {instance['InstanceId']} of type {instance_type} is up and running")
+    ec2 = ec2_client or aws_client('ec2')
+
+    with TRACER.span('create_instance', instance_type=instance_type, count=number_of_instance) as span:
+        instances = ec2.run_instances(
+            ImageId='ami-09e67e426f25ce0d7',  # Ubuntu Server image
+            MinCount=1,
+            MaxCount=number_of_instance,
+            InstanceType=instance_type,
+            KeyName='ec2-keypair'  # key-pair value
+        )
+        span['instance_ids'] = [instance['InstanceId'] for instance in instances['Instances']]
+
+        if wait:
+            wait_for_instances([instance['InstanceId'] for instance in instances['Instances']], ec2)
+            for instance in instances['Instances']:
+                print(
+                    f"--> Instance {instance['InstanceId']} of type {instance_type} is up and running")
 
     return instances
 
 
+def wait_for_instances(instance_ids, ec2_client=None, delay=5, max_attempts=120):
+    """
+    Waits until every given instance is running, polling all of them with one DescribeInstances call
+
+    Args:
+        instance_ids ([list]): [ids of the instances to wait for]
+        ec2_client (optional): [EC2 client to use]. Defaults to the shared client.
+        delay (int, optional): [seconds between two polls]. Defaults to 5.
+        max_attempts (int, optional): [number of polls before giving up]. Defaults to 120.
+    """
+    ec2 = ec2_client or aws_client('ec2')
+    waiter = ec2.get_waiter('instance_running')
+    with TRACER.span('wait_for_instances', instance_ids=list(instance_ids)):
+        waiter.wait(InstanceIds=list(instance_ids), WaiterConfig={'Delay': delay, 'MaxAttempts': max_attempts})
+
+
+def create_clusters(cluster_specs, ec2_client=None, launched=None, wait=True):
+    """
+    Launches every cluster at the same time and waits for all of their instances with a single waiter
+
+    Args:
+        cluster_specs ([dict]): [cluster name -> (instance type, number of instances)]
+        ec2_client (optional): [EC2 client to use]. Defaults to the shared client.
+        launched (callable, optional): [called with (cluster name, run_instances response) for every
+            launched cluster before waiting, even when another cluster failed to launch]. Defaults to None.
+        wait (bool, optional): [wait until the instances are running]. Defaults to True.
+
+    Returns:
+        [dict]: [cluster name -> run_instances response of the cluster]
+    """
+    ec2 = ec2_client or aws_client('ec2')
+    with ThreadPoolExecutor(max_workers=len(cluster_specs)) as executor:
+        launches = {name: executor.submit(TRACER.wrap(create_instance), instance_type, count, ec2, False)
+                    for name, (instance_type, count) in cluster_specs.items()}
+    clusters = {}
+    for name, launch in launches.items():
+        if launch.exception() is None:
+            clusters[name] = launch.result()
+            if launched:
+                launched(name, clusters[name])
+    for launch in launches.values():
+        launch.result()
+    if not wait:
+        return clusters
+
+    wait_for_instances([instance['InstanceId']
+                        for instances in clusters.values() for instance in instances['Instances']], ec2)
+    for name, instances in clusters.items():
+        for instance in instances['Instances']:
+            print(f"--> Instance {instance['InstanceId']} of type {instance['InstanceType']} "
+                  f"({name}) is up and running")
+    return clusters
+
+
 def terminate_instance(instance_information):
     """
     Terminates an instance
@@ -48,14 +529,14 @@ def terminate_instance(instance_information):
     Args:
         instance_information ([EC2 instance info]): [information regarding a single instance]
     """
-    ec2_client = boto3.client("ec2")
+    ec2_client = aws_client('ec2')
     response = ec2_client.terminate_instances(
         InstanceIds=[instance_information['InstanceId']])
     print(f"Instance {instance_information['InstanceId']} Terminated")
 
 
 def get_public_ip(instance_id):
-    ec2_client = boto3.client("ec2")
+    ec2_client = aws_client('ec2')
     reservations = ec2_client.describe_instances(
         InstanceIds=[instance_id]).get("Reservations")
 
@@ -64,45 +545,261 @@ def get_public_ip(instance_id):
             print(instance.get("PublicIpAddress"))
 
 
-def run_ssh_commands(instance):
+def get_public_ips(instance_ids, ec2_client=None):
+    """
+    Looks the public IP address of several instances up with one DescribeInstances call
+
+    Args:
+        instance_ids ([list]): [ids of the instances]
+        ec2_client (optional): [EC2 client to use]. Defaults to the shared client.
+
+    Returns:
+        [dict]: [instance id -> public IP address]
+    """
+    ec2 = ec2_client or aws_client('ec2')
+    reservations = ec2.describe_instances(InstanceIds=list(instance_ids)).get('Reservations')
+    return {instance['InstanceId']: instance.get('PublicIpAddress')
+            for reservation in reservations for instance in reservation['Instances']}
+
+
+def wait_for_port(host, port=22, timeout=300, interval=1.0):
+    """
+    Polls a TCP port until it accepts connections
+
+    Args:
+        host ([str]): [host name or IP address]
+        port (int, optional): [port to poll]. Defaults to 22.
+        timeout (int, optional): [seconds before giving up]. Defaults to 300.
+        interval (float, optional): [seconds between two attempts]. Defaults to 1.0.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection((host, port), timeout=interval):
+                return
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f'{host}:{port} did not accept connections within {timeout} sec')
+            time.sleep(interval)
+
+
+# outcome of the bootstrap of one host, timings maps every step to its duration in seconds
+BootstrapResult = namedtuple('BootstrapResult', ['host', 'ok', 'timings', 'error'])
+
+
+# wheelhouse and app sources built once on the control machine, digest identifies its content
+BootstrapBundle = namedtuple('BootstrapBundle', ['path', 'digest'])
+
+
+def build_bootstrap_bundle(cache_dir=BUNDLE_DIR, rebuild=False):
+    """
+    Builds (once) an archive holding the Flask wheels for the instances' Python and the app sources
+
+    Args:
+        cache_dir (str, optional): [directory the bundle is built and cached in]. Defaults to BUNDLE_DIR.
+        rebuild (bool, optional): [rebuild the bundle even if it is cached]. Defaults to False.
+
+    Returns:
+        [BootstrapBundle]: [path and sha256 digest of the archive]
+    """
+    path = os.path.join(cache_dir, 'bundle.tar.gz')
+    if rebuild or not os.path.exists(path):
+        wheelhouse = os.path.join(cache_dir, 'wheelhouse')
+        app = os.path.join(cache_dir, 'app')
+        if rebuild:
+            # stale wheels would be installed next to the new ones, and the old checkout reused
+            for directory in (wheelhouse, app):
+                shutil.rmtree(directory, ignore_errors=True)
+        subprocess.run([sys.executable, '-m', 'pip', 'download', *BUNDLE_REQUIREMENTS, '--dest', wheelhouse,
+                        '--only-binary=:all:', '--platform', TARGET_PLATFORM,
+                        '--python-version', TARGET_PYTHON_VERSION, '--implementation', 'cp'],
+                       check=True, stdout=subprocess.DEVNULL)
+        if not os.path.exists(app):
+            subprocess.run(['git', 'clone', '--depth', '1', APP_REPOSITORY, app], check=True)
+        with tarfile.open(path + '.tmp', 'w:gz') as bundle:
+            bundle.add(wheelhouse, arcname='wheelhouse')
+            bundle.add(app, arcname='app', filter=lambda info: None if info.name.split('/')[1:2] == ['.git'] else info)
+        os.replace(path + '.tmp', path)
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as bundle:
+        for chunk in iter(lambda: bundle.read(1 << 20), b''):
+            digest.update(chunk)
+    return BootstrapBundle(path, digest.hexdigest()[:16])
+
+
+def prepare_bootstrap_bundle(rebuild=False):
+    """
+    Builds the bootstrap bundle, or warns and returns None when it cannot be built (no network, no git...)
+    so that the instances fetch everything online instead
+
+    Args:
+        rebuild (bool, optional): [rebuild the bundle even if it is cached]. Defaults to False.
+
+    Returns:
+        [BootstrapBundle]: [the bundle, or None]
+    """
+    try:
+        with TRACER.span('build_bootstrap_bundle'):
+            return build_bootstrap_bundle(rebuild=rebuild)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'Could not build the bootstrap bundle, instances will fetch everything online: {e}')
+        return None
+
+
+def bundle_commands(bundle):
+    """
+    Returns the commands installing and starting the app from an uploaded bundle
+
+    Every install step writes a marker named after the bundle digest and is skipped when it is found,
+    and the app is only (re)started when it is not running yet or was started from another bundle, so
+    running them again on a warm host does next to nothing.
+
+    Args:
+        bundle ([BootstrapBundle]): [bundle uploaded to the host]
+
+    Returns:
+        [list]: [shell commands, the last one starts the app]
+    """
+    marker = f'~/.tp1/{bundle.digest}'
+    steps = [('unpacked', 'rm -rf ~/tp1 && mkdir -p ~/tp1 && tar xzf ~/tp1-bundle.tar.gz -C ~/tp1'),
+             # wheels are zip archives, extracting them is enough to install them without pip
+             ('installed', 'cd ~/tp1 && for wheel in wheelhouse/*.whl; do '
+                           'python3 -m zipfile -e "$wheel" vendor || exit 1; done')]
+    return (['mkdir -p ~/.tp1'] +
+            [f'test -f {marker}.{name} || ({command} && touch {marker}.{name})' for name, command in steps] +
+            # the app is tracked by its pid file (pgrep -f would also match this very command line)
+            # and ~/.tp1/running holds the digest of the bundle it was started from
+            ['pid=$(cat ~/.tp1/app.pid 2>/dev/null || echo 0); '
+             f'if test -d /proc/$pid && grep -qx {bundle.digest} ~/.tp1/running; then exit 0; fi; '
+             'test -d /proc/$pid && sudo kill $pid && sleep 1; '
+             f'echo {bundle.digest} > ~/.tp1/running && cd ~/tp1/app && '
+             '{ sudo nohup env PYTHONPATH=$HOME/tp1/vendor python3 hello.py > hello.log 2>&1 & echo $! > ~/.tp1/app.pid; }'])
+
+
+def upload_bundle(ssh, bundle):
+    """
+    Uploads a bundle over an open SSH connection unless the host already installed it
+
+    Args:
+        ssh ([paramiko.SSHClient]): [connected SSH client]
+        bundle ([BootstrapBundle]): [bundle to upload]
+
+    Returns:
+        [bool]: [whether the bundle had to be uploaded]
+    """
+    stdin, stdout, stderr = ssh.exec_command(f'test -f ~/.tp1/{bundle.digest}.installed')
+    if stdout.channel.recv_exit_status() == 0:
+        return False
+    sftp = ssh.open_sftp()
+    try:
+        sftp.put(bundle.path, 'tp1-bundle.tar.gz')
+    finally:
+        sftp.close()
+    return True
+
+
+def run_ssh_commands(host, commands=None, port=22, username=SSH_USERNAME, key_filename=KEY_FILENAME, bundle=None):
     """
-    Runs SSH commands one by one on a given instance
+    Runs SSH commands one by one on a given host
+
+    The host is polled until its SSH port is open, every command but the last one is waited for
+    and the last one (which starts the app) is only launched. When a bundle is given, it is uploaded
+    over the same connection and installed from local files instead of fetching everything online.
 
     Args:
-        instance ([EC2 Intance]): [an EC2 intance]
+        host ([str]): [host name or IP address]
+        commands (list, optional): [shell commands to run]. Defaults to BOOTSTRAP_COMMANDS, or the bundle_commands of {bundle}.
+        port (int, optional): [SSH port]. Defaults to 22.
+        username (str, optional): [SSH user]. Defaults to SSH_USERNAME.
+        key_filename (str, optional): [private key file]. Defaults to KEY_FILENAME.
+        bundle (BootstrapBundle, optional): [bundle to install from]. Defaults to None.
+
+    Returns:
+        [BootstrapResult]: [whether every command succeeded and how long each step took]
     """
+    timings = {}
+    step = None
+
+    @contextmanager
+    def timedStep(name, **attributes):
+        nonlocal step
+        step = name
+        start = time.monotonic()
+        try:
+            with TRACER.span('ssh ' + name, host=host, **attributes) as span:
+                yield span
+        finally:
+            timings[name] = time.monotonic() - start
+
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    privkey = paramiko.RSAKey.from_private_key_file('ec2-keypair.pem')
-
-    ec2 = boto3.resource('ec2')
-    instance = ec2.Instance(id=instance['InstanceId'])
-    # double check that instance is running before running commands
-    instance.wait_until_running()
-    ip_address = instance.public_ip_address
-    time.sleep(10)
     try:
-        ssh.connect(hostname=ip_address, username='ubuntu', pkey=privkey)
-        print(f'SSH connection to {ip_address} successful')
+        with TRACER.span('run_ssh_commands', host=host):
+            with timedStep('wait for ssh'):
+                wait_for_port(host, port, timeout=SSH_READY_TIMEOUT)
+
+            with timedStep('connect'):
+                privkey = paramiko.RSAKey.from_private_key_file(key_filename)
+                # sshd may accept connections a little before it is ready to authenticate
+                for attempt in range(SSH_CONNECT_RETRIES):
+                    try:
+                        ssh.connect(hostname=host, port=port, username=username, pkey=privkey,
+                                    timeout=10, banner_timeout=30)
+                        break
+                    except (paramiko.SSHException, OSError):
+                        if attempt == SSH_CONNECT_RETRIES - 1:
+                            raise
+                        time.sleep(2)
+
+            if bundle is not None:
+                with timedStep('upload bundle', digest=bundle.digest):
+                    upload_bundle(ssh, bundle)
+            if commands is None:
+                commands = BOOTSTRAP_COMMANDS if bundle is None else bundle_commands(bundle)
+
+            for command in commands[:-1]:
+                with timedStep(command, command=command) as span:
+                    stdin, stdout, stderr = ssh.exec_command(command)
+                    stdout.read()
+                    error = stderr.read()
+                    status = span['exit_status'] = stdout.channel.recv_exit_status()
+                if status != 0:
+                    message = error.decode(errors='replace').strip().splitlines()[-1:] or ['']
+                    return BootstrapResult(host, False, timings, f'"{command}" exited with {status}: {message[0]}')
+
+            with timedStep(commands[-1], command=commands[-1]):
+                ssh.exec_command(commands[-1])
+        return BootstrapResult(host, True, timings, None)
     except Exception as e:
-        print(e)
-    # install flask and deploy a simple script on each instance
-    commands = ['sudo apt-get update',
-                'yes | sudo apt install python3-pip',
-                'sudo pip install Flask',
-                'git clone "https://github.com/CommissarSilver/cloud-computing-tp1.git"',
-                'cd cloud-computing-tp1 && sudo python3 hello.py']
-    try:
-        for command in commands[:-1]:
-            print(command)
-            stdin, stdout, stderr = ssh.exec_command(command)
-            stdout.read()
-            stderr.read()
-
-        stdin, stdout, stderr = ssh.exec_command(commands[-1])
-        print('--> Commands executed successfully')
-    except Exception as e:
-        print(e)
+        return BootstrapResult(host, False, timings, f'{step}: {e}')
+    finally:
+        ssh.close()
+
+
+def bootstrap_instances(instances, max_workers=BOOTSTRAP_WORKERS, ec2_client=None, **ssh_options):
+    """
+    Runs the bootstrap commands on every given instance at the same time
+
+    Args:
+        instances ([list]): [instance descriptions, as found in a run_instances response]
+        max_workers (int, optional): [maximum number of hosts bootstrapped at the same time]. Defaults to BOOTSTRAP_WORKERS.
+        ec2_client (optional): [EC2 client to use]. Defaults to the shared client.
+        ssh_options : [extra keyword arguments of run_ssh_commands]
+
+    Returns:
+        [list]: [BootstrapResult of every instance]
+    """
+    ips = get_public_ips([instance['InstanceId'] for instance in instances], ec2_client)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ips)))) as executor:
+        results = list(executor.map(TRACER.wrap(lambda ip: run_ssh_commands(ip, **ssh_options)), ips.values()))
+
+    for instance_id, result in zip(ips, results):
+        slowest = max(result.timings, key=result.timings.get) if result.timings else '-'
+        print(f"--> {instance_id} ({result.host}) " + ('bootstrapped' if result.ok else 'FAILED') +
+              f" in {sum(result.timings.values()):.1f} sec, slowest step: {slowest}" +
+              ('' if result.ok else f'\n    {result.error}'))
+    return results
 
 
 def create_load_balancer(name, subnets):
@@ -116,7 +813,7 @@ def create_load_balancer(name, subnets):
     Returns:
         [load balancer response object]
     """
-    client = boto3.client('elbv2')
+    client = aws_client('elbv2')
     load_balancer_response = client.create_load_balancer(
         Name=name, Subnets=subnets)
     print('Load Balancer initialized successfully')
@@ -134,7 +831,7 @@ def create_target_group(name, load_balancer_response):
     Returns:
         target_group: target group reponse object 
     """
-    client = boto3.client('elbv2')
+    client = aws_client('elbv2')
     target_group = client.create_target_group(
         Name=name, Protocol='HTTP', Port=80, VpcId=load_balancer_response['LoadBalancers'][0]['VpcId'])
     print('Target Group initialized successfully')
@@ -152,6 +849,7 @@ def create_listener(target_group_response, load_balancer_response):
     Returns:
         listener object
     """
+    client = aws_client('elbv2')
     response = client.create_listener(DefaultActions=[
         {'TargetGroupArn': target_group_response['TargetGroups'][0]['TargetGroupArn'], 'Type': 'forward', }, ],
         LoadBalancerArn=load_balancer_response['LoadBalancers'][0]['LoadBalancerArn'],
@@ -162,6 +860,30 @@ def create_listener(target_group_response, load_balancer_response):
     return response
 
 
+def create_rule(listener_response, target_group_response, path_pattern, priority):
+    """
+    forwards the requests whose path matches {path_pattern} to the given target group
+
+    Args:
+        listener_response : [listener response object]
+        target_group_response : [target group response object]
+        path_pattern ([str]): [path pattern of the rule, like '*/cluster1']
+        priority ([int]): [priority of the rule]
+    """
+    client = aws_client('elbv2')
+    try:
+        client.create_rule(ListenerArn=listener_response['Listeners'][0]['ListenerArn'],
+                           Priority=priority,
+                           Conditions=[
+                               {'Field': 'path-pattern', 'Values': [path_pattern]}],
+                           Actions=[{'Type': 'forward',
+                                     'TargetGroupArn': target_group_response['TargetGroups'][0]['TargetGroupArn']}])
+    except ClientError as e:
+        # the rule was already created by an earlier, interrupted run
+        if e.response.get('Error', {}).get('Code') != 'PriorityInUse':
+            raise
+
+
 def register_to_target_group(target_group_response, instances):
     """
     binds given instances to given target group
@@ -170,339 +892,2235 @@ def register_to_target_group(target_group_response, instances):
         target_group_response : [target group response object]
         instances : [instance reponse object]
     """
+    client = aws_client('elbv2')
     client.register_targets(TargetGroupArn=target_group_response['TargetGroups'][0]['TargetGroupArn'], Targets=[
         {'Id': instance['InstanceId']} for instance in instances['Instances']])
 
 
-def test(load_balancer_url):
+def delete_load_balancer(load_balancer_response):
+    """
+    Deletes a load balancer along with its listeners and rules
+
+    Args:
+        load_balancer_response : [load balancer response object]
+    """
+    client = aws_client('elbv2')
+    arn = load_balancer_response['LoadBalancers'][0]['LoadBalancerArn']
+    client.delete_load_balancer(LoadBalancerArn=arn)
+    client.get_waiter('load_balancers_deleted').wait(LoadBalancerArns=[arn])
+
+
+def delete_target_group(target_group_response, retries=12, delay=5):
+    """
+    Deletes a target group, waiting for the listeners of a deleted load balancer to release it
+
+    Args:
+        target_group_response : [target group response object]
+        retries (int, optional): [attempts while the target group is still in use]. Defaults to 12.
+        delay (int, optional): [seconds between two attempts]. Defaults to 5.
+    """
+    client = aws_client('elbv2')
+    for attempt in range(retries):
+        try:
+            client.delete_target_group(TargetGroupArn=target_group_response['TargetGroups'][0]['TargetGroupArn'])
+            return
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ResourceInUse' or attempt == retries - 1:
+                raise
+            time.sleep(delay)
+
+
+def wait_for_healthy_targets(target_groups, timeout=HEALTH_TIMEOUT, elbv2_client=None, base_delay=2.0, max_delay=15.0):
+    """
+    Polls the health of every target group until all of their registered targets are healthy
+
+    Args:
+        target_groups ([dict]): [name -> target group response object]
+        timeout (int, optional): [seconds before giving up]. Defaults to HEALTH_TIMEOUT.
+        elbv2_client (optional): [elbv2 client to use]. Defaults to the shared client.
+        base_delay (float, optional): [seconds before the second poll]. Defaults to 2.0.
+        max_delay (float, optional): [maximum number of seconds between two polls]. Defaults to 15.0.
+
+    Returns:
+        [float]: [seconds it took for every target to be healthy]
+
+    Raises:
+        TimeoutError: [when some target is still not healthy after {timeout} seconds]
+    """
+    client = elbv2_client or aws_client('elbv2')
+    start = time.monotonic()
+    delay = base_delay
+    while True:
+        targets = []
+        for name, target_group in target_groups.items():
+            descriptions = client.describe_target_health(
+                TargetGroupArn=target_group['TargetGroups'][0]['TargetGroupArn'])
+            targets += [(name, d['Target']['Id'], d['TargetHealth']) for d in descriptions['TargetHealthDescriptions']]
+            if not descriptions['TargetHealthDescriptions']:
+                targets.append((name, '-', {'State': 'no registered target'}))
+
+        elapsed = time.monotonic() - start
+        if all(health['State'] == 'healthy' for _, _, health in targets):
+            print(f'--> All {len(targets)} targets are healthy after {elapsed:.0f} sec')
+            return elapsed
+        if elapsed + delay > timeout:
+            print(f'Targets are still not healthy after {elapsed:.0f} sec:')
+            for name, target_id, health in targets:
+                print(f"    {name:10} {target_id:20} {health['State']:12} {health.get('Reason', '')} "
+                      f"{health.get('Description', '')}")
+            raise TimeoutError(f'targets of {", ".join(target_groups)} are not healthy after {timeout} sec')
+        time.sleep(delay)
+        delay = min(max_delay, delay * 1.5)
+
+
+class TimeSeries:
+    """
+    Time series stored as two NumPy arrays: sample times (epoch seconds) and values
+
+    Missing samples hold NaN. Every operation is vectorized, so long windows at fine resolution do not
+    cost a Python loop per sample.
+    """
+
+    def __init__(self, times, values):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def period(self):
+        """
+        Median number of seconds between two samples
+        """
+        return float(np.median(np.diff(self.times))) if len(self.times) > 1 else 0.0
+
+    def datetimes(self):
+        """
+        Returns the sample times as numpy datetime64 values, ready to be plotted
+        """
+        return self.times.astype(np.int64).astype('datetime64[s]')
+
+    def resample(self, period, how='mean', start=None, end=None):
+        """
+        Aggregates the samples into buckets of {period} seconds
+
+        Args:
+            period ([float]): [bucket width in seconds]
+            how (str, optional): [aggregation: 'mean', 'sum', 'min' or 'max']. Defaults to 'mean'.
+            start (float, optional): [start of the first bucket]. Defaults to the first sample time floored to {period}.
+            end (float, optional): [end of the last bucket]. Defaults to just after the last sample.
+
+        Returns:
+            [TimeSeries]: [one sample per bucket, NaN for buckets without any value]
+        """
+        valid = ~np.isnan(self.values)
+        times, values = self.times[valid], self.values[valid]
+        if start is None:
+            start = (self.times.min() // period * period) if len(self.times) else 0.0
+        if end is None:
+            end = (self.times.max() // period + 1) * period if len(self.times) else start
+        grid = np.arange(start, end, period, dtype=np.float64)
+        index = ((times - start) // period).astype(np.int64)
+        inside = (index >= 0) & (index < len(grid))
+        index, values = index[inside], values[inside]
+
+        counts = np.bincount(index, minlength=len(grid))
+        if how in ('mean', 'sum'):
+            sums = np.bincount(index, weights=values, minlength=len(grid))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = sums / counts if how == 'mean' else np.where(counts > 0, sums, np.nan)
+        elif how in ('min', 'max'):
+            result = np.full(len(grid), np.nan)
+            (np.fmin if how == 'min' else np.fmax).at(result, index, values)
+        else:
+            raise ValueError(f'unknown aggregation {how}')
+        return TimeSeries(grid, result)
+
+    @staticmethod
+    def align(*series, period=None, how='mean'):
+        """
+        Resamples several series on a common time base
+
+        Args:
+            series : [TimeSeries to align]
+            period (float, optional): [period of the common time base]. Defaults to the largest period of the series.
+            how (str, optional): [aggregation used when resampling]. Defaults to 'mean'.
+
+        Returns:
+            [list]: [aligned TimeSeries, all with the same sample times]
+        """
+        period = period or max(s.period for s in series) or 1.0
+        non_empty = [s for s in series if len(s)]
+        if not non_empty:
+            return [TimeSeries([], []) for _ in series]
+        start = min(s.times.min() for s in non_empty) // period * period
+        end = (max(s.times.max() for s in non_empty) // period + 1) * period
+        return [s.resample(period, how, start, end) for s in series]
+
+    def rolling(self, window, how='mean'):
+        """
+        Computes a rolling aggregate over the last {window} samples, ignoring NaN
+
+        Args:
+            window ([int]): [number of samples in the window]
+            how (str, optional): [aggregation: 'mean' or 'sum']. Defaults to 'mean'.
+
+        Returns:
+            [TimeSeries]: [series with the same sample times]
+        """
+        valid = ~np.isnan(self.values)
+        sums = np.concatenate(([0.0], np.cumsum(np.where(valid, self.values, 0.0))))
+        counts = np.concatenate(([0], np.cumsum(valid)))
+        upper = np.arange(1, len(self.values) + 1)
+        lower = np.maximum(0, upper - window)
+        window_sums = sums[upper] - sums[lower]
+        window_counts = counts[upper] - counts[lower]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if how == 'mean':
+                result = window_sums / window_counts
+            elif how == 'sum':
+                result = np.where(window_counts > 0, window_sums, np.nan)
+            else:
+                raise ValueError(f'unknown aggregation {how}')
+        return TimeSeries(self.times, result)
+
+    def _combine(self, other, operator):
+        if isinstance(other, TimeSeries):
+            left, right = (self, other) if np.array_equal(self.times, other.times) else TimeSeries.align(self, other)
+            other = right.values
+        else:
+            left = self
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = operator(left.values, other)
+        values[~np.isfinite(values)] = np.nan
+        return TimeSeries(left.times, values)
+
+    def __add__(self, other):
+        return self._combine(other, np.add)
+
+    def __sub__(self, other):
+        return self._combine(other, np.subtract)
+
+    def __mul__(self, other):
+        return self._combine(other, np.multiply)
+
+    def __truediv__(self, other):
+        return self._combine(other, np.true_divide)
+
+
+# one CloudWatch metric to fetch, dimensions is a tuple of (name, value) pairs
+MetricSpec = namedtuple('MetricSpec', ['id', 'metric_name', 'dimensions', 'statistic', 'namespace'])
+MetricSpec.__new__.__defaults__ = ('AWS/ApplicationELB',)
+
+
+def load_balancer_dimension(load_balancer_response):
+    """
+    Returns the CloudWatch LoadBalancer dimension of a load balancer
+    """
+    arn = load_balancer_response['LoadBalancers'][0]['LoadBalancerArn']
+    return ('LoadBalancer', '/'.join(arn.split(':')[-1].split('/')[1:]))
+
+
+def target_group_dimension(target_group_response):
+    """
+    Returns the CloudWatch TargetGroup dimension of a target group
+    """
+    return ('TargetGroup', target_group_response['TargetGroups'][0]['TargetGroupArn'].split(':')[-1])
+
+
+class MetricsCache:
+    """
+    SQLite cache of CloudWatch datapoints keyed by namespace, metric, dimensions, statistic and period
+
+    Besides the datapoints, the cache records which time ranges were fetched for every key, so that
+    later queries only ask CloudWatch for the ranges it has never returned.
+    """
+
+    def __init__(self, path=METRICS_CACHE_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS datapoints (
+                key TEXT NOT NULL, timestamp INTEGER NOT NULL, value REAL NOT NULL,
+                PRIMARY KEY (key, timestamp)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS ranges (key TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS ranges_key ON ranges (key);
+        ''')
+
+    @staticmethod
+    def key(spec, period):
+        return json.dumps([spec.namespace, spec.metric_name, sorted(spec.dimensions), spec.statistic, period])
+
+    def missing(self, key, start, end):
+        """
+        Returns the (start, end) ranges of [start, end) that were never fetched for {key}
+        """
+        gaps = []
+        for fetched_start, fetched_end in self.db.execute(
+                'SELECT start, end FROM ranges WHERE key = ? AND end > ? AND start < ? ORDER BY start',
+                (key, start, end)):
+            if fetched_start > start:
+                gaps.append((start, fetched_start))
+            start = max(start, fetched_end)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+    def load(self, key, start, end):
+        """
+        Returns the cached (timestamp, value) datapoints of {key} in [start, end)
+        """
+        return self.db.execute('SELECT timestamp, value FROM datapoints WHERE key = ? AND timestamp >= ? '
+                               'AND timestamp < ? ORDER BY timestamp', (key, start, end)).fetchall()
+
+    def store(self, key, datapoints, start=None, end=None):
+        """
+        Stores datapoints of {key} and, when given, records [start, end) as fetched
+        """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?)',
+                                ((key, timestamp, value) for timestamp, value in datapoints))
+            if start is None or start >= end:
+                return
+            # merge the new range with the ones it overlaps or touches
+            for fetched_start, fetched_end in self.db.execute(
+                    'SELECT start, end FROM ranges WHERE key = ? AND end >= ? AND start <= ?',
+                    (key, start, end)).fetchall():
+                start, end = min(start, fetched_start), max(end, fetched_end)
+            self.db.execute('DELETE FROM ranges WHERE key = ? AND end >= ? AND start <= ?', (key, start, end))
+            self.db.execute('INSERT INTO ranges VALUES (?, ?, ?)', (key, start, end))
+
+    def close(self):
+        self.db.close()
+
+
+def get_metric_data(cloudwatch, specs, start, end, period):
+    """
+    Fetches the datapoints of several metrics over [start, end), following the pagination
+
+    Returns:
+        [dict]: [spec id -> list of (epoch seconds, value)]
+    """
+    datapoints = {spec.id: [] for spec in specs}
+    kwargs = {'MetricDataQueries': [{'Id': spec.id,
+                                     'MetricStat': {'Metric': {'Namespace': spec.namespace,
+                                                               'MetricName': spec.metric_name,
+                                                               'Dimensions': [{'Name': name, 'Value': value}
+                                                                              for name, value in spec.dimensions]},
+                                                    'Period': period,
+                                                    'Stat': spec.statistic}}
+                                    for spec in specs],
+              'StartTime': datetime.fromtimestamp(start, timezone.utc),
+              'EndTime': datetime.fromtimestamp(end, timezone.utc),
+              'ScanBy': 'TimestampAscending'}
+    while True:
+        response = cloudwatch.get_metric_data(**kwargs)
+        for result in response['MetricDataResults']:
+            datapoints[result['Id']] += [(int(timestamp.timestamp()), value)
+                                         for timestamp, value in zip(result['Timestamps'], result['Values'])]
+        if not response.get('NextToken'):
+            return datapoints
+        kwargs['NextToken'] = response['NextToken']
+
+
+def fetch_metrics(specs, start, end, period=METRICS_PERIOD, cloudwatch_client=None, cache=None):
+    """
+    Fetches several metrics with as few GetMetricData calls as possible
+
+    The specs are split into chunks that fit in one call, every chunk is paginated and the chunks
+    are fetched at the same time. Every series is aligned on the same time base, a period without
+    datapoint holds NaN. With a cache, only the time ranges it does not hold yet are fetched; the
+    last METRICS_CACHE_LAG seconds are never recorded as fetched since CloudWatch may still be
+    ingesting them.
+
+    Args:
+        specs ([list]): [MetricSpec objects, their ids must be unique]
+        start ([float]): [start of the time window (epoch seconds)]
+        end ([float]): [end of the time window (epoch seconds)]
+        period (int, optional): [seconds aggregated in a datapoint]. Defaults to METRICS_PERIOD.
+        cloudwatch_client (optional): [CloudWatch client to use]. Defaults to the shared client.
+        cache (MetricsCache, optional): [cache to read and fill]. Defaults to None.
+
+    Returns:
+        [dict]: [spec id -> TimeSeries, all on the same time base]
+    """
+    start = int(start) // period * period
+    end = -(-int(end) // period) * period
+
+    # (start, end) range -> specs that need it
+    wanted = {}
+    for spec in specs:
+        for gap in (cache.missing(cache.key(spec, period), start, end) if cache else [(start, end)]):
+            wanted.setdefault(gap, []).append(spec)
+
+    # a call returns at most MAX_METRIC_QUERIES series and MAX_METRIC_DATAPOINTS datapoints
+    jobs = []
+    for (gap_start, gap_end), gap_specs in wanted.items():
+        size = max(1, min(MAX_METRIC_QUERIES, MAX_METRIC_DATAPOINTS * period // max(period, gap_end - gap_start)))
+        jobs += [(gap_specs[i:i + size], gap_start, gap_end) for i in range(0, len(gap_specs), size)]
+
+    datapoints = {spec.id: [] for spec in specs}
+    if jobs:
+        cloudwatch = cloudwatch_client or aws_client('cloudwatch')
+        with TRACER.span('fetch_metrics', metrics=len(specs), calls=len(jobs)), \
+                ThreadPoolExecutor(max_workers=min(len(jobs), METRICS_WORKERS)) as executor:
+            results = list(executor.map(
+                TRACER.wrap(lambda job: get_metric_data(cloudwatch, job[0], job[1], job[2], period)), jobs))
+        settled = int(time.time() - METRICS_CACHE_LAG) // period * period
+        for (job_specs, job_start, job_end), result in zip(jobs, results):
+            for spec in job_specs:
+                if cache:
+                    cache.store(cache.key(spec, period), result[spec.id], job_start, min(job_end, settled))
+                else:
+                    datapoints[spec.id] += result[spec.id]
+    if cache:
+        for spec in specs:
+            datapoints[spec.id] = cache.load(cache.key(spec, period), start, end)
+
+    grid = np.arange(start, end, period, dtype=np.float64)
+    series = {}
+    for spec in specs:
+        points = np.array(datapoints[spec.id], dtype=np.float64).reshape(-1, 2)
+        values = np.full(len(grid), np.nan)
+        index = ((points[:, 0] - start) // period).astype(np.int64)
+        inside = (index >= 0) & (index < len(grid))
+        values[index[inside]] = points[inside, 1]
+        series[spec.id] = TimeSeries(grid, values)
+    return series
+
+
+# one PNG of the report, series is a tuple of (label, TimeSeries) pairs drawn on the same axes
+ChartSpec = namedtuple('ChartSpec', ['filename', 'series'])
+
+
+def render_chart(chart):
+    """
+    Renders a chart to its PNG file with the Agg backend, without going through pyplot's global state
+
+    Args:
+        chart ([ChartSpec]): [chart to render]
+
+    Returns:
+        [str]: [path of the PNG file]
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(15, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    for label, series in chart.series:
+        ax.plot(series.datetimes(), series.values, label=label)
+    ax.legend()
+    fig.savefig(chart.filename, dpi=fig.dpi)
+    # release the figure right away instead of waiting for the garbage collector
+    fig.clf()
+    return chart.filename
+
+
+def render_charts(charts, processes=REPORT_PROCESSES):
+    """
+    Renders several charts in a pool of processes
+
+    Args:
+        charts ([list]): [ChartSpec objects to render]
+        processes (int, optional): [number of rendering processes]. Defaults to REPORT_PROCESSES.
+
+    Returns:
+        [list]: [paths of the PNG files]
+    """
+    with TRACER.span('render_charts', charts=len(charts)):
+        if processes <= 1 or len(charts) <= 1:
+            return [render_chart(chart) for chart in charts]
+        with ProcessPoolExecutor(max_workers=min(processes, len(charts))) as pool:
+            return list(pool.map(render_chart, charts))
+
+
+class LatencyHistogram:
+    """
+    HDR-style latency histogram backed by a flat array of counters
+
+    Latencies are recorded in microseconds. Values below 2^SUB_BUCKET_BITS are counted exactly,
+    every power-of-two range above is split into 2^(SUB_BUCKET_BITS - 1) linear buckets, so the
+    relative error stays under 1% while the memory used does not depend on the number of requests.
+    """
+    SUB_BUCKET_BITS = 8
+    MAX_VALUE_BITS = 40  # ~12 days in microseconds, larger values are clamped
+
+    def __init__(self):
+        self.sub_bucket_count = 1 << self.SUB_BUCKET_BITS
+        self.sub_bucket_half = self.sub_bucket_count // 2
+        size = self.sub_bucket_count + (self.MAX_VALUE_BITS - self.SUB_BUCKET_BITS) * self.sub_bucket_half
+        self.counts = array('Q', bytes(8 * size))
+        self.total = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        top = value >> shift
+        return self.sub_bucket_count + (shift - 1) * self.sub_bucket_half + top - self.sub_bucket_half
+
+    def _highest_value(self, index):
+        if index < self.sub_bucket_count:
+            return index
+        shift, top = divmod(index - self.sub_bucket_count, self.sub_bucket_half)
+        shift += 1
+        return ((top + self.sub_bucket_half + 1) << shift) - 1
+
+    def record(self, latency):
+        """
+        Records one latency
+
+        Args:
+            latency ([float]): [latency in seconds]
+        """
+        value = min(int(latency * 1e6), (1 << self.MAX_VALUE_BITS) - 1)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram to this one
+
+        Args:
+            other ([LatencyHistogram]): [histogram to merge]
+        """
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        Returns the latency (in seconds) under which {percent}% of the recorded requests fall
+        """
+        if not self.total:
+            return 0.0
+        target = max(1, math.ceil(percent / 100 * self.total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_value(index), self.max) / 1e6
+        return self.max / 1e6
+
+
+class TargetStats:
+    """
+    Requests of a load test attributed to the instance (target) which served them, per cluster
+
+    Keeps a latency histogram and an error count per target, and counts how often two consecutive
+    responses of a cluster came from the same target to detect sticky routing. Not thread-safe on its
+    own: LoadTestStats updates it under its lock.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # (cluster, instance) -> LatencyHistogram
+        self.errors = {}  # (cluster, instance) -> number of 4xx/5xx responses
+        self.last = {}  # cluster -> instance of the last response
+        self.repeats = {}  # cluster -> [consecutive responses from the same target, consecutive responses]
+        self.sharded = False  # merged from several processes, stickiness is unknown
+
+    def record(self, cluster, instance, status, latency):
+        key = (cluster, instance)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+            self.errors[key] = 0
+        histogram.record(latency)
+        if status >= 400:
+            self.errors[key] += 1
+        if cluster in self.last:
+            repeats = self.repeats.setdefault(cluster, [0, 0])
+            repeats[0] += self.last[cluster] == instance
+            repeats[1] += 1
+        self.last[cluster] = instance
+
+    def merge(self, other):
+        for key, histogram in other.histograms.items():
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+                self.errors[key] = 0
+            self.histograms[key].merge(histogram)
+            self.errors[key] += other.errors[key]
+        # the requests are dealt round-robin to the shards, consecutive responses of a shard are
+        # every N-th response of the load balancer and tell nothing about sticky routing
+        self.repeats = {}
+        self.sharded = True
+
+    def flags(self, cluster, expected=None):
+        """
+        Returns the problems spotted in the distribution of the requests of {cluster} between its targets
+
+        Args:
+            cluster ([str]): [cluster name]
+            expected (int, optional): [number of targets registered in the cluster]. Defaults to the number of targets seen.
+
+        Returns:
+            [list]: [descriptions of the imbalance, sticky routing or slow targets found]
+        """
+        targets = {instance: histogram for (name, instance), histogram in self.histograms.items() if name == cluster}
+        flags = []
+        # which target served a response the app does not identify is unknown, the distribution
+        # checks would report false imbalances
+        unidentified = targets.pop(UNKNOWN_INSTANCE, None)
+        if unidentified is not None:
+            flags.append(f'responses do not identify their instance ({unidentified.total} requests), '
+                         f'the distribution between targets is not checked')
+        else:
+            total = sum(histogram.total for histogram in targets.values())
+            expected = expected or len(targets)
+            if len(targets) < expected:
+                flags.append(f'only {len(targets)} of {expected} targets served requests')
+            for instance, histogram in sorted(targets.items()):
+                share = histogram.total / total
+                if abs(share * expected - 1) > TARGET_IMBALANCE_THRESHOLD:
+                    flags.append(f'imbalance: {instance} served {share:.0%} of the requests, '
+                                 f'expected {1 / expected:.0%}')
+            same, transitions = self.repeats.get(cluster, (0, 0))
+            if not self.sharded and len(targets) > 1 and transitions and same / transitions > TARGET_STICKY_THRESHOLD:
+                flags.append(f'sticky routing: {same / transitions:.0%} of consecutive responses came from the '
+                             f'same target')
+        if len(targets) > 1:
+            medians = sorted(histogram.percentile(50) for histogram in targets.values())
+            typical = medians[(len(medians) - 1) // 2]
+            for instance, histogram in sorted(targets.items()):
+                if typical and histogram.percentile(50) > TARGET_SLOW_FACTOR * typical:
+                    flags.append(f'slow target: {instance} p50 is {histogram.percentile(50) / typical:.1f}x the cluster median')
+        return flags
+
+    def report(self, expected_targets=None):
+        """
+        Prints the request share, latency percentiles and error rate of every target, and the flags of every cluster
+
+        Args:
+            expected_targets (dict, optional): [cluster name -> number of registered targets]. Defaults to None.
+        """
+        expected_targets = expected_targets or {}
+        print('%-30s %7s %8s %10s %10s %10s' % ('target', 'share', 'count', 'p50 (ms)', 'p99 (ms)', 'errors'))
+        for cluster in sorted({cluster for cluster, _ in self.histograms}):
+            targets = sorted((instance, histogram) for (name, instance), histogram in self.histograms.items()
+                             if name == cluster)
+            total = sum(histogram.total for _, histogram in targets)
+            print(cluster)
+            for instance, histogram in targets:
+                print('  %-28s %6.1f%% %8d %10.1f %10.1f %9.2f%%' % (
+                    instance or '(no response)', 100 * histogram.total / total, histogram.total,
+                    histogram.percentile(50) * 1000, histogram.percentile(99) * 1000,
+                    100 * self.errors[(cluster, instance)] / histogram.total))
+            for flag in self.flags(cluster, expected_targets.get(cluster)):
+                print('  \033[0;31m' + flag + '\033[0m')
+
+
+class LoadTestStats:
+    """
+    Latency histograms of a load test bucketed by (cluster, status code)
+
+    Requests that did not get any response are recorded with status code 0. The requests answered by
+    an identifiable instance are also attributed to it in {targets}.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.targets = TargetStats()
+        self.lock = threading.Lock()
+
+    def record(self, cluster, status, latency, instance=''):
+        with self.lock:
+            histogram = self.histograms.get((cluster, status))
+            if histogram is None:
+                histogram = self.histograms[(cluster, status)] = LatencyHistogram()
+            histogram.record(latency)
+            if instance:
+                self.targets.record(cluster, instance, status, latency)
+
+    def merge(self, other):
+        """
+        Merges the histograms of another LoadTestStats into this one
+        """
+        with self.lock:
+            for key, histogram in other.histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = LatencyHistogram()
+                self.histograms[key].merge(histogram)
+            self.targets.merge(other.targets)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def cluster_histogram(self, cluster):
+        """
+        Returns the latency histogram of every request sent to {cluster}, whatever its status code
+        """
+        histogram = LatencyHistogram()
+        for (name, status), by_status in self.histograms.items():
+            if name == cluster:
+                histogram.merge(by_status)
+        return histogram
+
+    def error_count(self, cluster):
+        """
+        Returns the number of requests sent to {cluster} which failed or got a 4xx/5xx response
+        """
+        return sum(histogram.total for (name, status), histogram in self.histograms.items()
+                   if name == cluster and (status == 0 or status >= 400))
+
+    def report(self):
+        """
+        Prints p50/p90/p99/p99.9, max and error rate for every cluster and status code
+        """
+        def line(name, histogram):
+            return ('%-22s %8d' % (name, histogram.total) +
+                    ''.join('%10.1f' % (histogram.percentile(p) * 1000) for p in REPORT_PERCENTILES) +
+                    '%10.1f' % (histogram.max / 1000))
+
+        print('%-22s %8s' % ('latency (ms)', 'count') +
+              ''.join('%10s' % f'p{p:g}' for p in REPORT_PERCENTILES) + '%10s' % 'max')
+        for cluster in sorted({cluster for cluster, _ in self.histograms}):
+            histogram = self.cluster_histogram(cluster)
+            print(line(cluster, histogram) +
+                  '   errors %.2f%%' % (100 * self.error_count(cluster) / histogram.total))
+            for (name, status), by_status in sorted(self.histograms.items()):
+                if name == cluster:
+                    print(line(f'  status {status}', by_status))
+
+
+# one line of the load test results file
+RequestResult = namedtuple('RequestResult', ['timestamp', 'cluster', 'latency', 'status', 'instance'])
+
+
+def served_by(payload):
+    """
+    Extracts the identifier of the instance which served a request from the JSON it returned
+
+    Args:
+        payload : [decoded JSON body of the response]
+
+    Returns:
+        [str]: [instance identifier, or UNKNOWN_INSTANCE when the payload has none of INSTANCE_ID_KEYS]
+    """
+    if isinstance(payload, dict):
+        for key in INSTANCE_ID_KEYS:
+            if key in payload:
+                return str(payload[key])
+    # a payload changing on every request would otherwise make a new target (and histogram) per request
+    return UNKNOWN_INSTANCE
+
+
+class ResultSink:
+    """
+    Buffers per-request results and appends them to a CSV file in batches
+
+    The buffer is swapped under a lock and written outside of it, so worker threads only
+    pay for a list append on every request.
+    """
+
+    def __init__(self, path, batch_size=RESULTS_BATCH_SIZE):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(RequestResult._fields)
+        self.batch_size = batch_size
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+
+    def write(self, result):
+        with self.lock:
+            self.buffer.append(result)
+            if len(self.buffer) < self.batch_size:
+                return
+            batch, self.buffer = self.buffer, []
+        self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        with self.io_lock:
+            self.writer.writerows((r.timestamp, r.cluster, '%.6f' % r.latency, r.status, r.instance)
+                                  for r in batch)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        self._write_batch(batch)
+        self.file.close()
+
+
+class LiveTelemetry:
+    """
+    Sliding-window view of a running load test, per cluster: throughput, requests in flight and queued,
+    error rate and latency quantiles
+
+    Answered requests are counted in one-second buckets (count, errors and a latency histogram) and the
+    window is made of the last {window} complete seconds, so recording a request only touches the bucket
+    of the current second. Worker processes keep their own instance and forward the buckets of the
+    seconds that ended with drain() to the instance of the parent, which adds them with merge().
+    """
+
+    def __init__(self, window=TELEMETRY_WINDOW):
+        self.window = window
+        self.buckets = {}  # cluster -> {second: [count, errors, LatencyHistogram]}
+        self.in_flight = {}  # (source, cluster) -> requests sent but not answered yet
+        self.queued = {}  # (source, cluster) -> requests due but waiting for a free sending thread
+        self.totals = {}  # cluster -> [count, errors]
+        self.drained = 0  # buckets of the seconds before this one were already drained
+        self.first = None  # first second with an answered request
+        self.lock = threading.Lock()
+
+    def _bucket(self, cluster, second):
+        buckets = self.buckets.setdefault(cluster, {})
+        if second not in buckets:
+            # keep a few seconds more than the window for the buckets not drained yet
+            for old in [old for old in buckets if old <= second - self.window - 5]:
+                del buckets[old]
+            buckets[second] = [0, 0, LatencyHistogram()]
+            self.totals.setdefault(cluster, [0, 0])
+            self.first = second if self.first is None else min(self.first, second)
+        return buckets[second]
+
+    def scheduled(self, cluster):
+        """
+        Counts a request due for {cluster} as queued until a thread sends it
+        """
+        with self.lock:
+            self.queued[0, cluster] = self.queued.get((0, cluster), 0) + 1
+
+    def started(self, cluster):
+        """
+        Counts a request sent to {cluster} as in flight until its result is recorded
+        """
+        with self.lock:
+            self.queued[0, cluster] = self.queued.get((0, cluster), 0) - 1
+            self.in_flight[0, cluster] = self.in_flight.get((0, cluster), 0) + 1
+
+    def record(self, result):
+        """
+        Adds an answered request to the bucket of the current second
+
+        Args:
+            result ([RequestResult]): [result of the request]
+        """
+        error = result.status == 0 or result.status >= 400
+        with self.lock:
+            self.in_flight[0, result.cluster] = self.in_flight.get((0, result.cluster), 0) - 1
+            bucket = self._bucket(result.cluster, int(time.time()))
+            bucket[0] += 1
+            bucket[1] += error
+            bucket[2].record(result.latency)
+            totals = self.totals[result.cluster]
+            totals[0] += 1
+            totals[1] += error
+
+    def drain(self, final=False):
+        """
+        Returns the buckets of the seconds which ended since the last call and the requests in flight and queued
+
+        Args:
+            final (bool, optional): [also return the bucket of the current second]. Defaults to False.
+
+        Returns:
+            [tuple]: [(list of (cluster, second, count, errors, histogram), dict cluster -> in flight,
+                dict cluster -> queued)]
+        """
+        until = int(time.time()) + (1 if final else 0)
+        with self.lock:
+            buckets = [(cluster, second, count, errors, histogram)
+                       for cluster, by_second in self.buckets.items()
+                       for second, (count, errors, histogram) in by_second.items()
+                       if self.drained <= second < until]
+            self.drained = until
+            in_flight = {cluster: count for (_, cluster), count in self.in_flight.items()}
+            queued = {cluster: count for (_, cluster), count in self.queued.items()}
+        return buckets, in_flight, queued
+
+    def merge(self, source, buckets, in_flight, queued):
+        """
+        Adds buckets drained from the instance of another process
+
+        Args:
+            source ([int]): [identifier of the other process]
+            buckets ([list]): [(cluster, second, count, errors, histogram) tuples returned by drain()]
+            in_flight ([dict]): [cluster -> requests in flight in the other process]
+            queued ([dict]): [cluster -> requests queued in the other process]
+        """
+        with self.lock:
+            for cluster, second, count, errors, histogram in buckets:
+                bucket = self._bucket(cluster, second)
+                bucket[0] += count
+                bucket[1] += errors
+                bucket[2].merge(histogram)
+                totals = self.totals[cluster]
+                totals[0] += count
+                totals[1] += errors
+            for cluster, count in in_flight.items():
+                self.in_flight[source, cluster] = count
+            for cluster, count in queued.items():
+                self.queued[source, cluster] = count
+
+    def snapshot(self):
+        """
+        Returns the telemetry of every cluster over the last {window} complete seconds
+
+        Returns:
+            [dict]: [JSON-serializable telemetry, latencies in seconds]
+        """
+        now = int(time.time())
+        clusters = {}
+        with self.lock:
+            # the window is shorter than {window} seconds at the start of the test
+            span = min(self.window, now - self.first) if self.first is not None else 0
+            for cluster in sorted(set(self.totals) | {cluster for _, cluster in self.in_flight}):
+                count = errors = 0
+                histogram = LatencyHistogram()
+                for second, bucket in self.buckets.get(cluster, {}).items():
+                    if now - self.window <= second < now:
+                        count += bucket[0]
+                        errors += bucket[1]
+                        histogram.merge(bucket[2])
+                total, total_errors = self.totals.get(cluster, (0, 0))
+                clusters[cluster] = {
+                    'throughput': count / span if span > 0 else 0.0,
+                    'in_flight': sum(n for (_, name), n in self.in_flight.items() if name == cluster),
+                    'queued': sum(n for (_, name), n in self.queued.items() if name == cluster),
+                    'error_rate': errors / count if count else 0.0,
+                    'latency': {f'p{p:g}': histogram.percentile(p) for p in REPORT_PERCENTILES},
+                    'max_latency': histogram.max / 1e6,
+                    'total': total,
+                    'errors': total_errors,
+                }
+        return {'time': now, 'window': span, 'clusters': clusters}
+
+    def line(self):
+        """
+        Returns the snapshot formatted as a single console line
+        """
+        parts = []
+        for cluster, t in self.snapshot()['clusters'].items():
+            parts.append(f'{cluster} {t["throughput"]:.1f} req/s, {t["in_flight"]} in flight, {t["queued"]} queued, '
+                         f'{100 * t["error_rate"]:.1f}% errors, p50 {1000 * t["latency"]["p50"]:.1f} ms, '
+                         f'p99 {1000 * t["latency"]["p99"]:.1f} ms')
+        return ' | '.join(parts) or 'waiting for the first responses'
+
+
+class ProgressLine:
+    """
+    Console line redrawn every {interval} seconds with the live telemetry of the load test
+    """
+
+    def __init__(self, telemetry, interval=PROGRESS_INTERVAL):
+        self.telemetry = telemetry
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._draw()
+
+    def _draw(self):
+        print('\r' + self.telemetry.line() + '   ', end='', flush=True)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self._draw()
+        print()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TelemetryHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET with the current snapshot of the live telemetry as JSON
+    """
+
+    def do_GET(self):
+        body = json.dumps(self.server.telemetry.snapshot(), indent=2).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_telemetry(telemetry, port=TELEMETRY_PORT, host=TELEMETRY_HOST):
+    """
+    Serves the live telemetry on http://{host}:{port}/ from a background thread
+
+    Args:
+        telemetry ([LiveTelemetry]): [telemetry to serve]
+        port (int, optional): [local port to listen on]. Defaults to TELEMETRY_PORT.
+        host (str, optional): [address to listen on]. Defaults to TELEMETRY_HOST.
+
+    Returns:
+        [ThreadingHTTPServer]: [running server to shutdown() at the end of the test, None if the port is taken]
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), TelemetryHandler)
+    except OSError as error:
+        print(f'\033[1;33mLive telemetry not served on port {port}: {error}\033[0m')
+        return None
+    server.telemetry = telemetry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Live telemetry served on http://{host}:{server.server_address[1]}/')
+    return server
+
+
+class LoadProfile:
+    """
+    Target arrival rate of a scenario over time
+
+    The profile is a list of (duration, start_rate, end_rate) segments during which the rate (in
+    requests per second) changes linearly, which is enough to describe constant, ramp, step and
+    spike shapes.
+    """
+
+    def __init__(self, segments):
+        self.segments = [(float(duration), float(start_rate), float(end_rate))
+                         for duration, start_rate, end_rate in segments]
+
+    @classmethod
+    def constant(cls, rate, duration):
+        return cls([(duration, rate, rate)])
+
+    @classmethod
+    def ramp(cls, start_rate, end_rate, duration):
+        return cls([(duration, start_rate, end_rate)])
+
+    @classmethod
+    def step(cls, rates, step_duration):
+        return cls([(step_duration, rate, rate) for rate in rates])
+
+    @classmethod
+    def spike(cls, base_rate, spike_rate, duration, spike_start, spike_duration):
+        return cls([(spike_start, base_rate, base_rate),
+                    (spike_duration, spike_rate, spike_rate),
+                    (duration - spike_start - spike_duration, base_rate, base_rate)])
+
+    @property
+    def duration(self):
+        return sum(duration for duration, _, _ in self.segments)
+
+    @property
+    def count(self):
+        """
+        Number of requests sent over the whole profile
+        """
+        return sum(1 for _ in self.send_times())
+
+    def send_times(self):
+        """
+        Yields the intended send time of every request, in seconds from the start of the profile
+        """
+        elapsed = 0.0
+        sent = 0.0  # expected number of requests sent before the current segment
+        for duration, start_rate, end_rate in self.segments:
+            slope = (end_rate - start_rate) / duration if duration else 0.0
+            index = math.ceil(sent)
+            while True:
+                # solve start_rate * t + slope * t^2 / 2 = index - sent for t
+                remaining = index - sent
+                if slope:
+                    discriminant = start_rate ** 2 + 2 * slope * remaining
+                    if discriminant < 0:
+                        break
+                    offset = (math.sqrt(discriminant) - start_rate) / slope
+                elif start_rate:
+                    offset = remaining / start_rate
+                else:
+                    break
+                if offset >= duration:
+                    break
+                yield elapsed + offset
+                index += 1
+            elapsed += duration
+            sent += (start_rate + end_rate) / 2 * duration
+
+
+# a named load profile applied to one cluster
+Scenario = namedtuple('Scenario', ['name', 'cluster', 'profile'])
+
+SCENARIOS = [
+    Scenario('scenario1', 'cluster1', LoadProfile.constant(rate=20, duration=10)),  # 200 requests
+    Scenario('scenario2', 'cluster2', LoadProfile.ramp(start_rate=0, end_rate=50, duration=20)),  # 500 requests
+]
+
+
+def create_session(pool_size=DEFAULT_CONCURRENCY):
+    """
+    Creates an HTTP session whose connections are kept alive and shared between worker threads
+
+    Args:
+        pool_size (int, optional): [maximum number of pooled connections per host]. Defaults to DEFAULT_CONCURRENCY.
+
+    Returns:
+        [requests.Session]: [a session to be shared by every request of a load test]
+    """
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def send_request(session, target):
+    """
+    Sends one GET request
+
+    Returns:
+        [tuple]: [status code (0 without response), identifier of the instance which served it or '']
+    """
+    instance = ''
+    try:
+        r = session.get(target)
+        status = r.status_code
+        try:
+            instance = served_by(r.json())
+        except ValueError:
+            pass
+    except Exception:
+        status = 0
+    return status, instance
+
+
+def run_scenario(session, url, scenario, record, concurrency=DEFAULT_CONCURRENCY, shard=(0, 1), start_at=None,
+                 started=None, scheduled=None, closed_loop=False):
+    """
+    Sends the requests of a scenario on its load profile timetable (open loop)
+
+    Requests are issued at their intended send time whether or not the earlier ones have been answered,
+    and their latency is measured from that intended time, so a saturated target shows up as latency
+    instead of silently slowing the arrival rate down. In closed loop, a request is only issued once
+    one of the {concurrency} sending threads is free, its latency is measured from then, and the
+    scenario stops at the end of its profile: the timetable only caps the rate.
+
+    Args:
+        session ([requests.Session]): [session the requests are sent with]
+        url ([str]): [base URL of the load balancer]
+        scenario ([Scenario]): [cluster and load profile to run]
+        record ([callable]): [called with a RequestResult for every request]
+        concurrency (int, optional): [maximum number of requests in flight]. Defaults to DEFAULT_CONCURRENCY.
+        shard (tuple, optional): [(index, count): only every count-th request starting at index is sent]. Defaults to (0, 1).
+        start_at (float, optional): [wall-clock time the timetable starts at]. Defaults to now.
+        started (callable, optional): [called with the cluster name when a request is sent]. Defaults to None.
+        scheduled (callable, optional): [called with the cluster name when a request is due and queued
+            for a sending thread]. Defaults to None.
+        closed_loop (bool, optional): [wait for a free sending thread before issuing a request]. Defaults to False.
+    """
+    cluster = scenario.cluster
+    target = url + cluster
+    free = threading.Semaphore(concurrency) if closed_loop else None
+
+    def getOne(intended, timestamp):
+        try:
+            if started:
+                started(cluster)
+            status, instance = send_request(session, target)
+            record(RequestResult(timestamp, cluster, time.perf_counter() - intended, status, instance))
+        finally:
+            if free:
+                free.release()
+
+    start_timestamp = time.time() if start_at is None else start_at
+    start = time.perf_counter() + start_timestamp - time.time()
+    end = start + scenario.profile.duration
+    index, count = shard
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for offset in islice(scenario.profile.send_times(), index, None, count):
+            intended = start + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if free:
+                free.acquire()
+                # behind the timetable because of the servers, the request is due now
+                intended = max(intended, time.perf_counter())
+                if intended >= end:
+                    free.release()
+                    break
+            if scheduled:
+                scheduled(cluster)
+            executor.submit(getOne, intended, start_timestamp + intended - start)
+
+
+def run_scenarios(url, scenarios, concurrency, results_path, shard=(0, 1), start_at=None, verbose=True,
+                  telemetry=None, telemetry_queue=None, closed_loop=False):
+    """
+    Runs every scenario at the same time from the current process
+
+    Args:
+        url ([str]): [base URL of the load balancer]
+        scenarios ([list]): [Scenario objects to run]
+        concurrency ([int]): [maximum number of requests in flight per scenario]
+        results_path ([str]): [CSV file the per-request results are appended to]
+        shard (tuple, optional): [(index, count) share of the requests sent by this process]. Defaults to (0, 1).
+        start_at (float, optional): [wall-clock time the scenarios start at]. Defaults to now.
+        verbose (bool, optional): [print scenario banners]. Defaults to True.
+        telemetry (LiveTelemetry, optional): [live telemetry fed with every request]. Defaults to None.
+        telemetry_queue (optional): [queue receiving the drained telemetry of this process every second,
+            as (shard index, buckets, in flight) tuples]. Defaults to None.
+        closed_loop (bool, optional): [run the scenarios in closed loop, see run_scenario]. Defaults to False.
+
+    Returns:
+        [LoadTestStats]: [latency histograms of every request sent by this process]
+    """
+    # one pool of keep-alive connections shared by every scenario
+    session = create_session(pool_size=len(scenarios) * concurrency)
+
+    stats = LoadTestStats()
+    sink = ResultSink(results_path)
+    if telemetry_queue is not None:
+        telemetry = LiveTelemetry()
+        stopped = threading.Event()
+
+        def forwardTelemetry():
+            while not stopped.wait(1.0):
+                telemetry_queue.put((shard[0],) + telemetry.drain())
+            telemetry_queue.put((shard[0],) + telemetry.drain(final=True))
+
+        forwarder = threading.Thread(target=forwardTelemetry, daemon=True)
+        forwarder.start()
+
+    def record(result):
+        stats.record(result.cluster, result.status, result.latency, result.instance)
+        sink.write(result)
+        if telemetry:
+            telemetry.record(result)
+
+    def startScenario(color, scenario):
+        if verbose:
+            print(color + '-' * 15 + scenario.cluster + ' starts ' + scenario.name + '-' * 15 + '\033[0m')
+        start = time.time()
+        with TRACER.span('scenario ' + scenario.name, cluster=scenario.cluster, shard=list(shard)):
+            run_scenario(session, url, scenario, record, concurrency, shard, start_at,
+                         telemetry.started if telemetry else None, telemetry.scheduled if telemetry else None,
+                         closed_loop)
+        duration = time.time() - start
+
+        if verbose:
+            print('\n' + color + '-' * 8 + scenario.cluster + ' completed ' + scenario.name + ' in ' + '%.2f' %
+                  duration + ' sec' + '-' * 7 + '\033[0m', end='\n\n')
+
+    # every cluster is loaded at the same time
+    colors = ['\033[1;33m', '\033[1;36m']
+    with ThreadPoolExecutor(max_workers=len(scenarios)) as executor:
+        running = [executor.submit(TRACER.wrap(startScenario), colors[i % len(colors)], s)
+                   for i, s in enumerate(scenarios)]
+    try:
+        for future in running:
+            future.result()
+    finally:
+        sink.close()
+        if telemetry_queue is not None:
+            stopped.set()
+            forwarder.join()
+    return stats
+
+
+def results_paths(results_path, processes=LOAD_PROCESSES):
+    """
+    Returns the results files a load test run from {processes} processes writes to
+    """
+    if processes <= 1:
+        return [results_path]
+    root, ext = os.path.splitext(results_path)
+    return [f'{root}.{index}{ext}' for index in range(processes)]
+
+
+def run_shard(trace, url, scenarios, concurrency, results_path, shard, start_at, telemetry_queue, closed_loop):
+    """
+    Runs the scenarios of one shard in a worker process of shard_scenarios
+
+    Returns:
+        [tuple]: [LoadTestStats of the shard, spans it recorded when {trace} is set]
+    """
+    TRACER.reset(trace)
+    with TRACER.span('load shard', shard=list(shard), pid=os.getpid()):
+        stats = run_scenarios(url, scenarios, concurrency, results_path, shard, start_at, False, None,
+                              telemetry_queue, closed_loop)
+    return stats, TRACER.spans
+
+
+def shard_scenarios(url, scenarios, concurrency, results_path, processes, telemetry, closed_loop=False):
+    """
+    Runs every scenario at the same time from {processes} worker processes and merges their histograms
+
+    Returns:
+        [LoadTestStats]: [latency histograms of every request sent]
+    """
+    print(f'Sharding {", ".join(s.name for s in scenarios)} across {processes} processes')
+    # leave the workers time to start so that every shard follows the same timetable
+    start_at = time.time() + 2.0
+    stats = LoadTestStats()
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue()
+
+        def collectTelemetry():
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                telemetry.merge(*item)
+
+        collector = threading.Thread(target=collectTelemetry, daemon=True)
+        collector.start()
+        try:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                shards = [pool.submit(run_shard, TRACER.enabled, url, scenarios, concurrency, path,
+                                      (index, processes), start_at, queue, closed_loop)
+                          for index, path in enumerate(results_paths(results_path, processes))]
+                for index, shard in enumerate(shards):
+                    shard_stats, spans = shard.result()
+                    # the scenarios of the worker become children of the current span (the load test)
+                    TRACER.adopt(spans)
+                    print(f'\n--> Worker {index} sent ' +
+                          str(sum(h.total for h in shard_stats.histograms.values())) + ' requests')
+                    stats.merge(shard_stats)
+        finally:
+            queue.put(None)
+            collector.join()
+    return stats
+
+
+def test(load_balancer_url, scenarios=SCENARIOS, concurrency=DEFAULT_CONCURRENCY, results_path=RESULTS_PATH,
+         processes=LOAD_PROCESSES, expected_targets=None, telemetry_port=TELEMETRY_PORT, progress=True,
+         telemetry_host=TELEMETRY_HOST, closed_loop=False):
+    """
+    Runs every scenario at the same time against the load balancer
+
+    With more than one process, the requests of every scenario are dealt round-robin to {processes}
+    worker processes, each with its own connection pool and results file ({results_path} suffixed
+    with the worker index), and their histograms are merged into a single report.
+
+    While the test runs, the live telemetry of every cluster is redrawn on the console and served as
+    JSON on http://{telemetry_host}:{telemetry_port}/, the workers forward theirs to this process every second.
+
+    Args:
+        load_balancer_url ([str]): [DNS name of the load balancer]
+        scenarios (list, optional): [Scenario objects to run]. Defaults to SCENARIOS.
+        concurrency (int, optional): [maximum number of requests in flight per scenario and process]. Defaults to DEFAULT_CONCURRENCY.
+        results_path (str, optional): [CSV file the per-request results are appended to]. Defaults to RESULTS_PATH.
+        processes (int, optional): [number of load generating processes]. Defaults to LOAD_PROCESSES.
+        expected_targets (dict, optional): [cluster name -> number of registered targets]. Defaults to None.
+        telemetry_port (int, optional): [local port of the live telemetry endpoint, 0 to disable it]. Defaults to TELEMETRY_PORT.
+        progress (bool, optional): [redraw the live telemetry on the console]. Defaults to True.
+        telemetry_host (str, optional): [address the live telemetry endpoint listens on]. Defaults to TELEMETRY_HOST.
+        closed_loop (bool, optional): [run the scenarios in closed loop, see run_scenario]. Defaults to False.
+
+    Returns:
+        [LoadTestStats]: [latency histograms of every request sent]
+    """
     # DNS address of the load balancer, like
     url = f'http://{load_balancer_url}/'
 
-    def sendRequest(cluster, iter):
+    telemetry = LiveTelemetry()
+    server = serve_telemetry(telemetry, telemetry_port, telemetry_host) if telemetry_port else None
+    progress = ProgressLine(telemetry) if progress else None
+    try:
+        with TRACER.span('load test', url=url, processes=processes):
+            if processes <= 1:
+                stats = run_scenarios(url, scenarios, concurrency, results_path, telemetry=telemetry,
+                                      closed_loop=closed_loop)
+            else:
+                stats = shard_scenarios(url, scenarios, concurrency, results_path, processes, telemetry,
+                                        closed_loop)
+    finally:
+        if progress:
+            progress.close()
+        if server:
+            server.shutdown()
+            server.server_close()
+
+    stats.report()
+    stats.targets.report(expected_targets)
+    return stats
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers every GET like the Flask app deployed on the instances, with the id of the stand-in instance
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, Nagle's algorithm would delay the body by ~40 ms
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({'instance_id': self.server.instance_id, 'cluster': self.server.cluster}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PathRouterHandler(BaseHTTPRequestHandler):
+    """
+    Forwards every GET like the load balancer listener: to the target group of the first rule whose path
+    pattern matches, or to the default target group, round-robin between its stand-in instances
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        for pattern, backends in self.server.rules:
+            if pattern is None or fnmatchcase(self.path, pattern):
+                break
+        with self.server.lock:
+            port = next(backends)
+        connections = self.server.connections.__dict__
+        if port not in connections:
+            connections[port] = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            connections[port].request('GET', self.path)
+            response = connections[port].getresponse()
+            status, body = response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            connections.pop(port).close()
+            status, body = 502, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stand_in(instance_id, cluster, ports):
+    """
+    Serves one stand-in instance until the process is terminated
+
+    Args:
+        instance_id ([str]): [identifier the stand-in answers with]
+        cluster ([str]): [cluster of the stand-in]
+        ports ([multiprocessing.Queue]): [receives (instance_id, port) once it listens]
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.instance_id, server.cluster = instance_id, cluster
+    ports.put((instance_id, server.server_address[1]))
+    server.serve_forever()
+
+
+def serve_router(rules, ports):
+    """
+    Serves the path router in front of the stand-ins until the process is terminated
+
+    Args:
+        rules ([list]): [(path pattern, or None for the default rule, list of backend ports) in priority order]
+        ports ([multiprocessing.Queue]): [receives ('router', port) once it listens]
+    """
+    router = ThreadingHTTPServer(('127.0.0.1', 0), PathRouterHandler)
+    router.rules = [(pattern, cycle(backends)) for pattern, backends in rules]
+    router.lock, router.connections = threading.Lock(), threading.local()
+    ports.put(('router', router.server_address[1]))
+    router.serve_forever()
+
+
+def start_stand_ins(clusters):
+    """
+    Starts a process per stand-in instance of every cluster and a process for the path router in
+    front of them, so that neither shares its GIL with another server or with the load generator
+
+    Args:
+        clusters ([dict]): [cluster name -> (instance type, number of instances)]
+
+    Returns:
+        [tuple]: [port of the router, list of the started processes to terminate]
+    """
+    ports = multiprocessing.Queue()
+    processes = []
+    for name, (_, count) in clusters.items():
+        for index in range(count):
+            processes.append(multiprocessing.Process(
+                target=serve_stand_in, args=(f'stand-in-{name}-{index}', name, ports), daemon=True))
+            processes[-1].start()
+    instance_ports = dict(ports.get(timeout=30) for _ in processes)
+    rules = [(f'*/{name}', [instance_ports[f'stand-in-{name}-{index}'] for index in range(count)])
+             for name, (_, count) in clusters.items()]
+    # like the listener, unmatched paths go to the first target group
+    rules.append((None, rules[0][1]))
+    processes.append(multiprocessing.Process(target=serve_router, args=(rules, ports), daemon=True))
+    processes[-1].start()
+    return ports.get(timeout=30)[1], processes
+
+
+def benchmark(baseline_path=BENCHMARK_BASELINE_PATH, update_baseline=False, concurrency=DEFAULT_CONCURRENCY,
+              processes=LOAD_PROCESSES, duration=BENCHMARK_DURATION):
+    """
+    Measures the capacity of the load generator against local stand-ins of the clusters and the load
+    balancer, and compares it with a recorded baseline
+
+    The requests go through the same load test as the scenarios (scheduler, sending threads, results
+    file and live telemetry), but in closed loop for {duration} seconds: every sending thread issues a
+    request as soon as the previous one is answered, so that a slower client shows up as a lower
+    throughput even when it could still keep up with the scenarios' timetable. A baseline is only
+    compared with runs using the same processes, concurrency and duration. On a machine with few cores
+    the stand-ins compete with the load generator for CPU, compare baselines recorded on the same
+    machine only.
+
+    Args:
+        baseline_path (str, optional): [JSON file holding the baseline]. Defaults to BENCHMARK_BASELINE_PATH.
+        update_baseline (bool, optional): [record this run as the new baseline]. Defaults to False.
+        concurrency (int, optional): [requests in flight per cluster and process]. Defaults to DEFAULT_CONCURRENCY.
+        processes (int, optional): [load generating processes]. Defaults to LOAD_PROCESSES.
+        duration (float, optional): [seconds to send requests for]. Defaults to BENCHMARK_DURATION.
+
+    Returns:
+        [bool]: [False when the throughput regressed by more than BENCHMARK_TOLERANCE, or when the
+            baseline was recorded with other settings]
+    """
+    settings = {'mode': 'closed-loop', 'processes': processes, 'concurrency': concurrency, 'duration': duration}
+    scenarios = [Scenario('benchmark', name, LoadProfile.constant(rate=BENCHMARK_MAX_RATE, duration=duration))
+                 for name in CLUSTERS]
+    paths = results_paths(BENCHMARK_RESULTS_PATH, processes)
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    router, stand_ins = start_stand_ins(CLUSTERS)
+    try:
+        print(f'Sending requests back to back for {duration} sec from {processes} process(es)')
+        stats = test(f'127.0.0.1:{router}', scenarios, concurrency, BENCHMARK_RESULTS_PATH, processes,
+                     {name: count for name, (_, count) in CLUSTERS.items()}, telemetry_port=0, progress=False,
+                     closed_loop=True)
+    finally:
+        for process in stand_ins:
+            process.terminate()
+            process.join()
+
+    histogram = LatencyHistogram()
+    for by_status in stats.histograms.values():
+        histogram.merge(by_status)
+    errors = sum(stats.error_count(cluster) for cluster in {cluster for cluster, _ in stats.histograms})
+    # from the first request sent to the last one answered, leaving the start of the processes out
+    timestamps, latencies, _ = read_results(paths)
+    elapsed = (timestamps + latencies).max() - timestamps.min() if len(timestamps) else duration
+    results = dict(settings,
+                   throughput=histogram.total / elapsed,
+                   p50=histogram.percentile(50),
+                   p99=histogram.percentile(99),
+                   error_rate=errors / max(1, histogram.total))
+
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if 'processes' not in baseline:
+            print(f'--> {baseline_path} was recorded by an older benchmark, replacing it')
+            baseline = None
+    print(f"Benchmark: {results['throughput']:.0f} req/s, p50 {results['p50'] * 1000:.1f} ms, "
+          f"p99 {results['p99'] * 1000:.1f} ms, errors {results['error_rate'] * 100:.2f}%")
+    if baseline is None or update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'--> Baseline recorded in {baseline_path}')
+        return True
+
+    different = ', '.join(f'{key}={baseline.get(key)}' for key, value in settings.items() if baseline.get(key) != value)
+    if different:
+        print(f'\033[0;31mThe baseline was recorded with {different}\033[0m, rerun with the same settings '
+              f'or record a new baseline with --update-baseline')
+        return False
+    print(f"Baseline:  {baseline['throughput']:.0f} req/s, p50 {baseline['p50'] * 1000:.1f} ms, "
+          f"p99 {baseline['p99'] * 1000:.1f} ms, errors {baseline['error_rate'] * 100:.2f}%")
+    if results['throughput'] < baseline['throughput'] * (1 - BENCHMARK_TOLERANCE):
+        print(f"\033[0;31mThroughput regressed by more than {BENCHMARK_TOLERANCE:.0%}\033[0m")
+        return False
+    return True
+
+
+# one configuration of the sweep matrix, profile_name names the LoadProfile in the matrix
+SweepCell = namedtuple('SweepCell', ['name', 'instance_type', 'count', 'profile_name', 'profile'])
+
+
+def load_sweep_matrix(path):
+    """
+    Reads a sweep matrix: every combination of its instance types, instance counts and load profiles is a cell
+
+    The file is a JSON object like {"instance_types": ["t2.micro", "t3.small"], "counts": [1, 2, 4],
+    "profiles": {"ramp": {"ramp": {"start_rate": 10, "end_rate": 400, "duration": 300}}},
+    "prices": {"t3.small": 0.0208}}. A profile is either the keyword arguments of one of the
+    LoadProfile constructors (constant, ramp, step, spike) or {"segments": [[duration, start_rate, end_rate], ...]}.
+    Prices (USD per hour) are optional and override INSTANCE_PRICES.
+
+    Args:
+        path ([str]): [JSON file holding the matrix]
+
+    Returns:
+        [tuple]: [list of SweepCell, dict instance type -> hourly price]
+    """
+    with open(path) as f:
+        matrix = json.load(f)
+    profiles = {}
+    for name, spec in matrix['profiles'].items():
+        (shape, arguments), = spec.items()
+        if shape == 'segments':
+            profiles[name] = LoadProfile(arguments)
+        elif shape in ('constant', 'ramp', 'step', 'spike'):
+            profiles[name] = getattr(LoadProfile, shape)(**arguments)
+        else:
+            raise ValueError(f'unknown load profile shape {shape!r} in {path}')
+
+    cells = []
+    for instance_type in matrix['instance_types']:
+        for count in matrix['counts']:
+            for profile_name, profile in profiles.items():
+                # load balancer and target group names: at most 32 letters, digits and hyphens
+                name = f'sweep{len(cells)}-{instance_type.replace(".", "-")}-x{count}'[:32].rstrip('-')
+                cells.append(SweepCell(name, instance_type, int(count), profile_name, profile))
+    prices = dict(INSTANCE_PRICES, **matrix.get('prices', {}))
+    missing = sorted({cell.instance_type for cell in cells} - set(prices))
+    if missing:
+        raise ValueError(f'no price for {", ".join(missing)}, add them to "prices" in {path}')
+    return cells, prices
+
+
+class VcpuBudget:
+    """
+    On-demand vCPUs the sweep cells can reserve before launching their instances
+
+    Cells wait until enough vCPUs are free, so independent cells run in parallel only as far as
+    the EC2 quota allows.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, vcpus):
+        if vcpus > self.total:
+            raise ValueError(f'{vcpus} vCPUs needed, only {self.total} available under the EC2 quota')
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= vcpus)
+            self.free -= vcpus
         try:
-            for i in range(iter):
-                print('%3d' % i + ': ', end='')
-                r = requests.get(url + cluster)
+            yield
+        finally:
+            with self.condition:
+                self.free += vcpus
+                self.condition.notify_all()
+
+
+def available_vcpus(ec2_client=None):
+    """
+    Returns the on-demand standard instance vCPU quota minus the vCPUs of the instances already running
+
+    Returns:
+        [int]: [vCPUs the sweep may use, SWEEP_VCPU_BUDGET when the quota can not be read]
+    """
+    ec2 = ec2_client or aws_client('ec2')
+    try:
+        quota = aws_client('service-quotas').get_service_quota(ServiceCode='ec2', QuotaCode='L-1216C47A')
+        total = int(quota['Quota']['Value'])
+    except ClientError as e:
+        print(f'Could not read the EC2 vCPU quota, using {SWEEP_VCPU_BUDGET} vCPUs: {e}')
+        return SWEEP_VCPU_BUDGET
+    used = 0
+    for page in ec2.get_paginator('describe_instances').paginate(
+            Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                cpu = instance.get('CpuOptions', {})
+                used += cpu.get('CoreCount', 1) * cpu.get('ThreadsPerCore', 1)
+    return max(0, total - used)
+
+
+def instance_vcpus(instance_types, ec2_client=None):
+    """
+    Returns the default number of vCPUs of every given instance type
+    """
+    ec2 = ec2_client or aws_client('ec2')
+    response = ec2.describe_instance_types(InstanceTypes=sorted(set(instance_types)))
+    return {description['InstanceType']: description['VCpuInfo']['DefaultVCpus']
+            for description in response['InstanceTypes']}
+
+
+def read_results(paths):
+    """
+    Reads load test results files
+
+    Returns:
+        [tuple]: [numpy arrays of the send timestamps, latencies and status codes]
+    """
+    rows = []
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                rows += [(float(row['timestamp']), float(row['latency']), int(row['status']))
+                         for row in csv.DictReader(f)]
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return rows[:, 0], rows[:, 1], rows[:, 2].astype(np.int64)
+
+
+def saturation_point(timestamps, latencies, statuses, duration, window=SWEEP_WINDOW):
+    """
+    Splits the requests of a load test into windows of send time and finds the first saturated window
+
+    A window is saturated when its p99 latency is above SWEEP_LATENCY_SLO or its error rate above
+    SWEEP_MAX_ERROR_RATE. With an increasing load profile, the offered rate of the first saturated
+    window is the saturation point and the best throughput before it the sustained throughput.
+
+    Args:
+        timestamps ([numpy.ndarray]): [intended send time of every request]
+        latencies ([numpy.ndarray]): [latency of every request in seconds]
+        statuses ([numpy.ndarray]): [status code of every request, 0 without response]
+        duration ([float]): [duration of the load profile in seconds, incomplete windows are left out]
+        window (int, optional): [seconds in a window]. Defaults to SWEEP_WINDOW.
+
+    Returns:
+        [tuple]: [list of per-window dicts, sustained throughput (req/s), offered rate at saturation or None]
+    """
+    if not len(timestamps):
+        return [], 0.0, None
+    window = min(window, duration)
+    index = ((timestamps - timestamps.min()) // window).astype(np.int64)
+    windows = []
+    sustained, saturation = 0.0, None
+    for w in range(int(duration // window)):
+        inside = index == w
+        count = int(inside.sum())
+        if not count:
+            continue
+        ok = int(((statuses[inside] >= 200) & (statuses[inside] < 400)).sum())
+        p99 = float(np.percentile(latencies[inside], 99))
+        error_rate = 1 - ok / count
+        saturated = p99 > SWEEP_LATENCY_SLO or error_rate > SWEEP_MAX_ERROR_RATE
+        windows.append({'start': w * window, 'offered': count / window, 'throughput': ok / window,
+                        'p99': p99, 'error_rate': error_rate, 'saturated': saturated})
+        if saturated and saturation is None:
+            saturation = count / window
+        if saturation is None:
+            sustained = max(sustained, ok / window)
+    return windows, sustained, saturation
+
+
+def run_sweep_cell(cell, budget, vcpus, bundle, options, telemetry_port=0):
+    """
+    Provisions one sweep cell (instances, load balancer and target group), load tests it and tears it down
+
+    Args:
+        cell ([SweepCell]): [configuration to test]
+        budget ([VcpuBudget]): [vCPUs shared by the cells]
+        vcpus ([int]): [vCPUs of the cell]
+        bundle ([BootstrapBundle]): [bundle the instances are bootstrapped from, or None]
+        options ([argparse.Namespace]): [command line options]
+        telemetry_port (int, optional): [local port of the live telemetry of the cell, 0 to disable it]. Defaults to 0.
+
+    Returns:
+        [dict]: [results of the cell, with the error which stopped it if any]
+    """
+    result = {'cell': cell, 'error': None}
+    results_path = f'sweep_{cell.name}.csv'
+    for path in results_paths(results_path, options.processes):
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        with budget.reserve(vcpus), TRACER.span('sweep cell', cell=cell.name, instance_type=cell.instance_type,
+                                                count=cell.count, profile=cell.profile_name):
+            instances = create_instance(cell.instance_type, cell.count, wait=False)
+            result['instances'] = [instance['InstanceId'] for instance in instances['Instances']]
+            try:
+                wait_for_instances(result['instances'])
+                failed = [r.host for r in bootstrap_instances(instances['Instances'], bundle=bundle) if not r.ok]
+                if failed:
+                    raise RuntimeError(f'bootstrap failed on {", ".join(failed)}')
+                load_balancer = create_load_balancer(name=cell.name, subnets=SUBNETS)
+                target_group = None
                 try:
-                    print(str(r.json()) + '\tstatus ' + str(r.status_code))
-                except:
-                    print(
-                        '\033[0;31mFailed to responce\033[0m\t\t\tstatus ' + str(r.status_code))
-        except Exception as e:
-            print(f"Exception occured in sending requests: \n {e}")
-
-    def scenario1(cluster):
-        print('\033[1;33m' + '-' * 15 + cluster +
-              ' starts scenario1' + '-' * 15 + '\033[0m')
-        start = time.time()
-        sendRequest(cluster, 200)
-        duration = time.time() - start
+                    target_group = create_target_group(name=cell.name, load_balancer_response=load_balancer)
+                    create_listener(target_group_response=target_group, load_balancer_response=load_balancer)
+                    register_to_target_group(target_group, instances)
+                    wait_for_healthy_targets({cell.name: target_group})
+
+                    result['load_balancer'] = load_balancer_dimension(load_balancer)
+                    result['start'] = time.time()
+                    stats = test(load_balancer['LoadBalancers'][0]['DNSName'],
+                                 [Scenario(cell.profile_name, SWEEP_PATH, cell.profile)],
+                                 options.concurrency, results_path, options.processes,
+                                 {SWEEP_PATH: cell.count}, telemetry_port, progress=False,
+                                 telemetry_host=options.telemetry_host)
+                    result['end'] = time.time()
+                    result['stats'] = stats
+                finally:
+                    delete_load_balancer(load_balancer)
+                    if target_group is not None:
+                        delete_target_group(target_group)
+            finally:
+                for instance in instances['Instances']:
+                    terminate_instance(instance)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+        print(f'\033[0;31mSweep cell {cell.name} failed: {result["error"]}\033[0m')
+        return result
 
-        print('\033[1;33m' + '-' * 8, end='')
-        print(cluster + ' completed scenario1 in ' + '%.2f' %
-              duration + ' sec', end='')
-        print('-' * 7 + '\033[0m', end='\n\n')
+    result['windows'], result['sustained'], result['saturation'] = saturation_point(
+        *read_results(results_paths(results_path, options.processes)), cell.profile.duration)
+    return result
 
-    def scenario2(cluster):
-        print('\033[1;36m' + '-' * 15 + cluster +
-              ' starts scenario2' + '-' * 15 + '\033[0m')
-        start = time.time()
-        sendRequest(cluster, 500)
-        duration = time.time() - start
 
-        print('\033[1;36m' + '-' * 8, end='')
-        print(cluster + ' completed scenario2 in ' + '%.2f' %
-              duration + ' sec', end='')
-        print('-' * 7 + '\033[0m', end='\n\n')
-
-    scenario1('cluster1')
-    scenario2('cluster2')
-
-
-print('Initializaing Instances:')
-cluster1_instances = create_instance('t2.micro', 2)
-cluster2_instances = create_instance('t2.micro', 2)
-
-print('Running SSH commands')
-for instance in cluster1_instances['Instances']:
-    run_ssh_commands(instance)
-for instance in cluster2_instances['Instances']:
-    run_ssh_commands(instance)
-
-client = boto3.client('elbv2')
-load_balancer_1 = create_load_balancer(name='LoadBalancerOne',
-                                       subnets=['subnet-03c5c7430a5220718', 'subnet-0ea8ee263c594b48c',
-                                                'subnet-05b40d02f69eb368a', 'subnet-0b43452ba329ed175',
-                                                'subnet-0c5bb5c903b5dbd9d', 'subnet-04159a4fcc1d12324'])
-
-cluster1_target_group = create_target_group(
-    name='cluster1', load_balancer_response=load_balancer_1)
-cluster2_target_group = create_target_group(
-    name='cluster2', load_balancer_response=load_balancer_1)
-
-listener = create_listener(
-    target_group_response=cluster1_target_group, load_balancer_response=load_balancer_1)
-
-print('Assigning rules to listener')
-client.create_rule(ListenerArn=listener['Listeners'][0]['ListenerArn'],
-                   Priority=1,
-                   Conditions=[
-                       {'Field': 'path-pattern', 'Values': ['*/cluster1']}],
-                   Actions=[{'Type': 'forward',
-                             'TargetGroupArn': cluster1_target_group['TargetGroups'][0]['TargetGroupArn']}])
-client.create_rule(ListenerArn=listener['Listeners'][0]['ListenerArn'],
-                   Priority=2,
-                   Conditions=[
-                       {'Field': 'path-pattern', 'Values': ['*/cluster2']}],
-                   Actions=[{'Type': 'forward',
-                             'TargetGroupArn': cluster2_target_group['TargetGroups'][0]['TargetGroupArn']}])
-
-register_to_target_group(cluster1_target_group, cluster1_instances)
-register_to_target_group(cluster2_target_group, cluster2_instances)
-
-print('Initialization Finished.\n Starting Test. (sleep for 60s for initialization to finish.')
-time.sleep(60)
-test(load_balancer_1['LoadBalancers'][0]['DNSName'])
-
-cloudwatch = boto3.client('cloudwatch', region_name='us-east-1')
-response = cloudwatch.list_metrics(Namespace='AWS/ApplicationELB')
-print(cluster1_target_group['TargetGroups'][0]['TargetGroupArn'].split(':')[-1])
-
-load_balancer_request_counts_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                                    MetricName='RequestCount',
-                                                                    Dimensions=[
-                                                                        {'Name': 'LoadBalancer',
-                                                                         'Value': '/'.join(
-                                                                             load_balancer_1['LoadBalancers'][0][
-                                                                                 'LoadBalancerArn'].split(':')[
-                                                                                 -1].split('/')[1:])}
-                                                                    ],
-                                                                    StartTime=datetime.utcnow() - timedelta(
-                                                                        seconds=1200),
-                                                                    EndTime=datetime.utcnow(),
-                                                                    Period=1,
-                                                                    Statistics=['Sum'])
-
-active_connection_counts_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                                MetricName='ActiveConnectionCount',
-                                                                Dimensions=[
-                                                                    {'Name': 'LoadBalancer',
-                                                                     'Value': '/'.join(
-                                                                         load_balancer_1['LoadBalancers'][0][
-                                                                             'LoadBalancerArn'].split(':')[
-                                                                             -1].split('/')[1:])}
-                                                                ],
-                                                                StartTime=datetime.utcnow() - timedelta(
-                                                                    seconds=1200),
-                                                                EndTime=datetime.utcnow(),
-                                                                Period=1,
-                                                                Statistics=['Sum'])
-
-new_connection_counts_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                             MetricName='NewConnectionCount',
-                                                             Dimensions=[
-                                                                 {'Name': 'LoadBalancer',
-                                                                  'Value': '/'.join(
-                                                                      load_balancer_1['LoadBalancers'][0][
-                                                                          'LoadBalancerArn'].split(':')[
-                                                                          -1].split('/')[1:])}
-                                                             ],
-                                                             StartTime=datetime.utcnow() - timedelta(
-                                                                 seconds=1200),
-                                                             EndTime=datetime.utcnow(),
-                                                             Period=1,
-                                                             Statistics=['Sum'])
-
-rule_evaluations_counts_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                               MetricName='RuleEvaluations',
-                                                               Dimensions=[
-                                                                   {'Name': 'LoadBalancer',
-                                                                    'Value': '/'.join(
-                                                                        load_balancer_1['LoadBalancers'][0][
-                                                                            'LoadBalancerArn'].split(':')[
-                                                                            -1].split('/')[1:])}
-                                                               ],
-                                                               StartTime=datetime.utcnow() - timedelta(
-                                                                   seconds=1200),
-                                                               EndTime=datetime.utcnow(),
-                                                               Period=1,
-                                                               Statistics=['Sum'])
-
-target_response_time_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                            MetricName='TargetResponseTime',
-                                                            Dimensions=[
-                                                                {'Name': 'LoadBalancer',
-                                                                 'Value': '/'.join(
-                                                                     load_balancer_1['LoadBalancers'][0][
-                                                                         'LoadBalancerArn'].split(':')[
-                                                                         -1].split('/')[1:])}
-                                                            ],
-                                                            StartTime=datetime.utcnow() - timedelta(
-                                                                seconds=1200),
-                                                            EndTime=datetime.utcnow(),
-                                                            Period=1,
-                                                            Statistics=['Sum'])
-
-cluster1_target_response_time_avg = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                            MetricName='TargetResponseTime',
-                                                            Dimensions=[
-                                                                {'Name': 'TargetGroup', 'Value':
-                                                                    cluster1_target_group['TargetGroups'][0][
-                                                                        'TargetGroupArn'].split(':')[-1]
-                                                                 },
-                                                                {'Name': 'LoadBalancer',
-                                                                 'Value': '/'.join(
-                                                                     load_balancer_1['LoadBalancers'][0][
-                                                                         'LoadBalancerArn'].split(':')[
-                                                                         -1].split('/')[1:])}
-                                                            ],
-                                                            StartTime=datetime.utcnow() - timedelta(
-                                                                seconds=1200),
-                                                            EndTime=datetime.utcnow(),
-                                                            Period=1,
-                                                            Statistics=['Average'])
-
-cluster2_target_response_time_avg = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                            MetricName='TargetResponseTime',
-                                                            Dimensions=[
-                                                                {'Name': 'TargetGroup', 'Value':
-                                                                    cluster2_target_group['TargetGroups'][0][
-                                                                        'TargetGroupArn'].split(':')[-1]
-                                                                 },
-                                                                {'Name': 'LoadBalancer',
-                                                                 'Value': '/'.join(
-                                                                     load_balancer_1['LoadBalancers'][0][
-                                                                         'LoadBalancerArn'].split(':')[
-                                                                         -1].split('/')[1:])}
-                                                            ],
-                                                            StartTime=datetime.utcnow() - timedelta(
-                                                                seconds=1200),
-                                                            EndTime=datetime.utcnow(),
-                                                            Period=1,
-                                                            Statistics=['Average'])
-
-cluster1_target_request_time_per_counter_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                            MetricName='RequestCountPerTarget',
-                                                            Dimensions=[
-                                                                {'Name': 'TargetGroup', 'Value':
-                                                                    cluster1_target_group['TargetGroups'][0][
-                                                                        'TargetGroupArn'].split(':')[-1]
-                                                                 },
-                                                                {'Name': 'LoadBalancer',
-                                                                 'Value': '/'.join(
-                                                                     load_balancer_1['LoadBalancers'][0][
-                                                                         'LoadBalancerArn'].split(':')[
-                                                                         -1].split('/')[1:])}
-                                                            ],
-                                                            StartTime=datetime.utcnow() - timedelta(
-                                                                seconds=1200),
-                                                            EndTime=datetime.utcnow(),
-                                                            Period=1,
-                                                            Statistics=['Sum'])
-
-cluster2_target_request_time_per_counter_sum = cloudwatch.get_metric_statistics(Namespace='AWS/ApplicationELB',
-                                                            MetricName='RequestCountPerTarget',
-                                                            Dimensions=[
-                                                                {'Name': 'TargetGroup', 'Value':
-                                                                    cluster2_target_group['TargetGroups'][0][
-                                                                        'TargetGroupArn'].split(':')[-1]
-                                                                 },
-                                                                {'Name': 'LoadBalancer',
-                                                                 'Value': '/'.join(
-                                                                     load_balancer_1['LoadBalancers'][0][
-                                                                         'LoadBalancerArn'].split(':')[
-                                                                         -1].split('/')[1:])}
-                                                            ],
-                                                            StartTime=datetime.utcnow() - timedelta(
-                                                                seconds=1200),
-                                                            EndTime=datetime.utcnow(),
-                                                            Period=1,
-                                                            Statistics=['Sum'])
-
-y_axis = []
-x_axis = []
-for data in sorted(load_balancer_request_counts_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    x_axis.append(data['Timestamp'])
-    y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(x_axis, y_axis, label='Load Balancer Request Counts - Sum')
-plt.legend()
-fig.savefig('EB_Request_Count_demo.png', dpi=fig.dpi)
-
-y_axis = []
-x_axis = []
-for data in sorted(active_connection_counts_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    x_axis.append(data['Timestamp'])
-    y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(x_axis, y_axis, label='Active Connection Counts - Sum')
-plt.legend()
-fig.savefig('Active_Conn_Count_demo.png', dpi=fig.dpi)
-
-y_axis = []
-x_axis = []
-for data in sorted(new_connection_counts_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    x_axis.append(data['Timestamp'])
-    y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(x_axis, y_axis, label='New Connection Counts - Sum')
-plt.legend()
-fig.savefig('New_Conn_Count_demo.png', dpi=fig.dpi)
-
-y_axis = []
-x_axis = []
-for data in sorted(rule_evaluations_counts_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    x_axis.append(data['Timestamp'])
-    y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(x_axis, y_axis, label='Rule Evaluation Counts - Sum')
-plt.legend()
-fig.savefig('Rule_Eva_Count_demo.png', dpi=fig.dpi)
-
-y_axis = []
-x_axis = []
-for data in sorted(target_response_time_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    x_axis.append(data['Timestamp'])
-    y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(x_axis, y_axis, label='Load Balancer Target Response Time - Sum')
-plt.legend()
-fig.savefig('LB_Resp_T_demo.png', dpi=fig.dpi)
-
-cluster1_y_axis = []
-cluster1_x_axis = []
-cluster2_y_axis = []
-cluster2_x_axis = []
-for data in sorted(cluster1_target_response_time_avg['Datapoints'], key=lambda d: d['Timestamp']):
-    cluster1_x_axis.append(data['Timestamp'])
-    cluster1_y_axis.append(data['Average'])
-for data in sorted(cluster2_target_response_time_avg['Datapoints'], key=lambda d: d['Timestamp']):
-    cluster2_x_axis.append(data['Timestamp'])
-    cluster2_y_axis.append(data['Average'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(cluster1_x_axis, cluster1_y_axis, label='Cluster 1 Target Response Time - Average')
-plt.plot(cluster2_x_axis, cluster2_y_axis, label='Cluster 2 Target Response Time - Average')
-plt.legend()
-fig.savefig('Cluster_Avg_T_demo.png', dpi=fig.dpi)
-
-cluster1_y_axis = []
-cluster1_x_axis = []
-cluster2_y_axis = []
-cluster2_x_axis = []
-for data in sorted(cluster1_target_request_time_per_counter_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    cluster1_x_axis.append(data['Timestamp'])
-    cluster1_y_axis.append(data['Sum'])
-for data in sorted(cluster2_target_request_time_per_counter_sum['Datapoints'], key=lambda d: d['Timestamp']):
-    cluster2_x_axis.append(data['Timestamp'])
-    cluster2_y_axis.append(data['Sum'])
-fig = plt.figure(figsize=(15, 10))
-plt.plot(cluster1_x_axis, cluster1_y_axis, label='Cluster 1 Target Request Time Per Counter - Sum')
-plt.plot(cluster2_x_axis, cluster2_y_axis, label='Cluster 2 Target Request Time Per Counter - Sum')
-plt.legend()
-fig.savefig('Cluster_Avg_Sum_demo.png', dpi=fig.dpi)
-
-for instance in cluster1_instances['Instances']:
-    terminate_instance(instance)
-
-for instance in cluster2_instances['Instances']:
-    terminate_instance(instance)
+def sweep_metrics(results):
+    """
+    Fetches the CloudWatch metrics of every tested sweep cell with one batch of GetMetricData calls
+
+    The metrics are fetched once METRICS_CACHE_LAG seconds have passed since the end of the last
+    test, before that CloudWatch may still be ingesting the datapoints of the last cells.
+
+    Returns:
+        [dict]: [cell name -> {metric name -> value over the test of the cell}]
+    """
+    tested = [result for result in results if result['error'] is None]
+    if not tested:
+        return {}
+    wait = max(result['end'] for result in tested) + METRICS_CACHE_LAG - time.time()
+    if wait > 0:
+        print(f'Waiting {wait:.0f} sec for CloudWatch to ingest the metrics of the last cells')
+        with TRACER.span('wait for metrics'):
+            time.sleep(wait)
+    specs = []
+    for index, result in enumerate(tested):
+        load_balancer = result['load_balancer']
+        specs += [MetricSpec(f'cell{index}_requests', 'RequestCount', (load_balancer,), 'Sum'),
+                  MetricSpec(f'cell{index}_response_time', 'TargetResponseTime', (load_balancer,), 'Average'),
+                  MetricSpec(f'cell{index}_target_5xx', 'HTTPCode_Target_5XX_Count', (load_balancer,), 'Sum')]
+        specs += [MetricSpec(f'cell{index}_cpu{number}', 'CPUUtilization', (('InstanceId', instance_id),),
+                             'Average', 'AWS/EC2')
+                  for number, instance_id in enumerate(result['instances'])]
+
+    cache = MetricsCache()
+    try:
+        series = fetch_metrics(specs, start=min(r['start'] for r in tested) - METRICS_PERIOD,
+                               end=max(r['end'] for r in tested) + 2 * METRICS_PERIOD, cache=cache)
+    finally:
+        cache.close()
+
+    metrics = {}
+    # cells without datapoints (yet) get NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for index, result in enumerate(tested):
+            cpu = [series[f'cell{index}_cpu{number}'].values for number in range(len(result['instances']))]
+            metrics[result['cell'].name] = {
+                'requests': float(np.nansum(series[f'cell{index}_requests'].values)),
+                'response_time': float(np.nanmean(series[f'cell{index}_response_time'].values)),
+                'target_5xx': float(np.nansum(series[f'cell{index}_target_5xx'].values)),
+                'peak_cpu': float(np.nanmax(np.nanmean(cpu, axis=0))) if cpu else float('nan'),
+            }
+    return metrics
+
+
+def sweep(matrix_path, options, report_path=SWEEP_REPORT_PATH):
+    """
+    Provisions and load tests every cell of a sweep matrix, running as many cells at the same time as
+    SWEEP_WORKERS and the EC2 vCPU quota allow, then reports how they compare
+
+    Every cell gets its own instances, load balancer and target group, named after the cell, and is
+    torn down as soon as it was tested. The report ranks the cells by sustained throughput per dollar
+    (requests per second per USD of instances per hour) and shows their saturation point.
+
+    Args:
+        matrix_path ([str]): [JSON file holding the matrix, see load_sweep_matrix]
+        options ([argparse.Namespace]): [command line options]
+        report_path (str, optional): [CSV file the comparison is written to]. Defaults to SWEEP_REPORT_PATH.
+
+    Returns:
+        [list]: [results of every cell]
+    """
+    cells, prices = load_sweep_matrix(matrix_path)
+    vcpus = instance_vcpus([cell.instance_type for cell in cells])
+    budget = VcpuBudget(available_vcpus())
+    print(f'Sweeping {len(cells)} cells with {budget.total} vCPUs available')
+    bundle = prepare_bootstrap_bundle(rebuild=options.rebuild_bundle)
+
+    with ThreadPoolExecutor(max_workers=SWEEP_WORKERS) as executor:
+        running = [executor.submit(TRACER.wrap(run_sweep_cell), cell, budget,
+                                   vcpus[cell.instance_type] * cell.count, bundle, options,
+                                   options.telemetry_port + 1 + index if options.telemetry_port else 0)
+                   for index, cell in enumerate(cells)]
+        results = [future.result() for future in running]
+
+    metrics = sweep_metrics(results)
+    rows = []
+    for result in results:
+        cell = result['cell']
+        cost = prices[cell.instance_type] * cell.count
+        row = {'cell': cell.name, 'instance_type': cell.instance_type, 'count': cell.count,
+               'profile': cell.profile_name, 'cost_per_hour': cost, 'error': result['error'] or ''}
+        if result['error'] is None:
+            histogram = LatencyHistogram()
+            for by_status in result['stats'].histograms.values():
+                histogram.merge(by_status)
+            row.update({'requests': histogram.total,
+                        'p50': histogram.percentile(50), 'p99': histogram.percentile(99),
+                        'error_rate': result['stats'].error_count(SWEEP_PATH) / max(1, histogram.total),
+                        'sustained_rps': result['sustained'], 'saturation_rps': result['saturation'],
+                        'rps_per_dollar': result['sustained'] / cost})
+            row.update({f'cloudwatch_{name}': value for name, value in metrics.get(cell.name, {}).items()})
+        rows.append(row)
+
+    rows.sort(key=lambda row: -row.get('rps_per_dollar', -1))
+    print('%-32s %7s %10s %10s %10s %12s %12s %10s %8s' % (
+        'cell', 'profile', 'p50 (ms)', 'p99 (ms)', 'errors', 'sustained', 'saturation', 'req/s/$', 'CPU'))
+    for row in rows:
+        if row['error']:
+            print('%-32s %7s  \033[0;31m%s\033[0m' % (row['cell'], row['profile'], row['error']))
+            continue
+        saturation = '%.1f req/s' % row['saturation_rps'] if row['saturation_rps'] is not None else 'not reached'
+        print('%-32s %7s %10.1f %10.1f %9.2f%% %6.1f req/s %12s %10.0f %7.0f%%' % (
+            row['cell'], row['profile'], row['p50'] * 1000, row['p99'] * 1000, 100 * row['error_rate'],
+            row['sustained_rps'], saturation, row['rps_per_dollar'], row.get('cloudwatch_peak_cpu', float('nan'))))
+
+    fields = []
+    for row in rows:
+        fields += [field for field in row if field not in fields]
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'--> Sweep report written to {report_path}')
+    return results
+
+
+def load_state(path=STATE_PATH):
+    """
+    Loads the state of the deployment saved by an earlier run, or an empty state
+    """
+    if not os.path.exists(path):
+        return {'completed': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    """
+    Saves the state of the deployment, replacing the state file atomically
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def requires(state, key, phase):
+    if key not in state:
+        raise RuntimeError(f'no {key} in the state file, run the {phase} phase first')
+    return state[key]
+
+
+def saved_instances(state, cluster):
+    """
+    Rebuilds the part of a run_instances response the other functions use from the saved state
+    """
+    return {'Instances': [{'InstanceId': instance_id}
+                          for instance_id in requires(state, 'clusters', 'provision')[cluster]['instances']]}
+
+
+def saved_load_balancer(state):
+    return {'LoadBalancers': [requires(state, 'load_balancer', 'load_balancer')]}
+
+
+def saved_target_group(state, cluster):
+    return {'TargetGroups': [{'TargetGroupArn': requires(state, 'target_groups', 'load_balancer')[cluster]}]}
+
+
+def provision_phase(state, options):
+    print('Initializaing Instances:')
+    clusters = state.setdefault('clusters', {})
+
+    def record(name, instances):
+        # saved before waiting, so that a failed wait can still be torn down
+        clusters[name] = {'instance_type': CLUSTERS[name][0],
+                          'instances': [instance['InstanceId'] for instance in instances['Instances']]}
+
+    # clusters launched by an earlier, interrupted run are only waited for
+    missing = {name: spec for name, spec in CLUSTERS.items() if name not in clusters}
+    if missing:
+        create_clusters(missing, launched=record, wait=False)
+    wait_for_instances([instance_id for cluster in clusters.values() for instance_id in cluster['instances']])
+    for name, cluster in clusters.items():
+        for instance_id in cluster['instances']:
+            print(f"--> Instance {instance_id} of type {cluster['instance_type']} ({name}) is up and running")
+
+
+def bootstrap_phase(state, options):
+    print('Running SSH commands')
+    bundle = prepare_bootstrap_bundle(rebuild=options.rebuild_bundle)
+    results = bootstrap_instances([instance for name in requires(state, 'clusters', 'provision')
+                                   for instance in saved_instances(state, name)['Instances']], bundle=bundle)
+    failed = [result.host for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f'bootstrap failed on {", ".join(failed)}')
+
+
+def load_balancer_phase(state, options):
+    clusters = requires(state, 'clusters', 'provision')
+    load_balancer = create_load_balancer(name=LOAD_BALANCER_NAME, subnets=SUBNETS)
+    state['load_balancer'] = {key: load_balancer['LoadBalancers'][0][key]
+                              for key in ('LoadBalancerArn', 'DNSName', 'VpcId')}
+
+    target_groups = {name: create_target_group(name=name, load_balancer_response=load_balancer)
+                     for name in clusters}
+    state['target_groups'] = {name: target_group['TargetGroups'][0]['TargetGroupArn']
+                              for name, target_group in target_groups.items()}
+
+    listener = create_listener(
+        target_group_response=next(iter(target_groups.values())), load_balancer_response=load_balancer)
+    state['listener'] = listener['Listeners'][0]['ListenerArn']
+
+    print('Assigning rules to listener')
+    for priority, (name, target_group) in enumerate(target_groups.items(), 1):
+        create_rule(listener, target_group, f'*/{name}', priority)
+
+    for name, target_group in target_groups.items():
+        register_to_target_group(target_group, saved_instances(state, name))
+    print('Initialization Finished.')
+
+
+def health_phase(state, options):
+    print('Waiting for the targets to be healthy before starting the test.')
+    wait_for_healthy_targets({name: saved_target_group(state, name)
+                              for name in requires(state, 'target_groups', 'load_balancer')})
+
+
+def test_phase(state, options):
+    start = time.time()
+    test(requires(state, 'load_balancer', 'load_balancer')['DNSName'],
+         concurrency=options.concurrency, processes=options.processes,
+         expected_targets={name: len(cluster['instances']) for name, cluster in requires(state, 'clusters', 'provision').items()},
+         telemetry_port=options.telemetry_port, telemetry_host=options.telemetry_host)
+    state['test'] = {'start': start, 'end': time.time()}
+
+
+def collect_metrics(state):
+    """
+    Fetches the CloudWatch metrics of the last test (through the metrics cache) and derives the report metrics
+
+    Returns:
+        [dict]: [metric id -> TimeSeries]
+    """
+    load_balancer = load_balancer_dimension(saved_load_balancer(state))
+    metric_specs = [
+        MetricSpec('load_balancer_request_counts_sum', 'RequestCount', (load_balancer,), 'Sum'),
+        MetricSpec('active_connection_counts_sum', 'ActiveConnectionCount', (load_balancer,), 'Sum'),
+        MetricSpec('new_connection_counts_sum', 'NewConnectionCount', (load_balancer,), 'Sum'),
+        MetricSpec('rule_evaluations_counts_sum', 'RuleEvaluations', (load_balancer,), 'Sum'),
+        MetricSpec('target_response_time_sum', 'TargetResponseTime', (load_balancer,), 'Sum'),
+    ]
+    for name in requires(state, 'target_groups', 'load_balancer'):
+        cluster = target_group_dimension(saved_target_group(state, name))
+        metric_specs += [
+            MetricSpec(f'{name}_target_response_time_avg', 'TargetResponseTime', (cluster, load_balancer), 'Average'),
+            MetricSpec(f'{name}_target_request_time_per_counter_sum', 'RequestCountPerTarget',
+                       (cluster, load_balancer), 'Sum'),
+        ]
+
+    # metrics around the last test, or the last METRICS_WINDOW seconds
+    end = time.time()
+    start = end - METRICS_WINDOW
+    if 'test' in state:
+        start = state['test']['start'] - METRICS_PERIOD
+        end = min(end, state['test']['end'] + 2 * METRICS_PERIOD)
+
+    cache = MetricsCache()
+    try:
+        metrics = fetch_metrics(metric_specs, start=start, end=end, cache=cache)
+    finally:
+        cache.close()
+    # derived metrics
+    for name in state['target_groups']:
+        metrics[f'{name}_requests_per_target_per_second'] = \
+            metrics[f'{name}_target_request_time_per_counter_sum'] / METRICS_PERIOD
+    if 'cluster1' in state['target_groups'] and 'cluster2' in state['target_groups']:
+        metrics['cluster_latency_ratio'] = \
+            metrics['cluster1_target_response_time_avg'] / metrics['cluster2_target_response_time_avg']
+    return metrics
+
+
+def metrics_phase(state, options):
+    metrics = collect_metrics(state)
+    print(f'--> Fetched {len(metrics)} metrics')
+
+
+def report_phase(state, options):
+    metrics = collect_metrics(state)
+    charts = render_charts([ChartSpec(filename, tuple((label, metrics[name]) for name, label in series))
+                            for filename, series in REPORT_CHARTS
+                            if all(name in metrics for name, _ in series)])
+    print(f'--> Rendered {", ".join(charts)}')
+
+
+def teardown_phase(state, options):
+    # every resource is dropped from the state once deleted, so that a failed teardown can be resumed
+    if 'load_balancer' in state:
+        delete_load_balancer(saved_load_balancer(state))
+        print(f"Load balancer {state['load_balancer']['LoadBalancerArn']} deleted")
+        del state['load_balancer']
+        state.pop('listener', None)
+    for name in list(state.get('target_groups', {})):
+        delete_target_group(saved_target_group(state, name))
+        print(f'Target group {name} deleted')
+        del state['target_groups'][name]
+    state.pop('target_groups', None)
+    for name in requires(state, 'clusters', 'provision'):
+        for instance in saved_instances(state, name)['Instances']:
+            terminate_instance(instance)
+    # the next provision phase launches new instances instead of waiting for these
+    del state['clusters']
+
+
+# every phase of a run, in order, the state file records the completed ones
+PHASES = [
+    ('provision', provision_phase),
+    ('bootstrap', bootstrap_phase),
+    ('load_balancer', load_balancer_phase),
+    ('health', health_phase),
+    ('test', test_phase),
+    ('metrics', metrics_phase),
+    ('report', report_phase),
+    ('teardown', teardown_phase),
+]
+PHASE_NAMES = [name for name, _ in PHASES]
+
+
+def run_phases(names, state, options, state_path=STATE_PATH):
+    """
+    Runs the given phases in order, saving the state after every phase
+
+    Args:
+        names ([list]): [names of the phases to run]
+        state ([dict]): [state of the deployment]
+        options ([argparse.Namespace]): [command line options]
+        state_path (str, optional): [state file]. Defaults to STATE_PATH.
+    """
+    for name, phase in PHASES:
+        if name not in names:
+            continue
+        print(f'\033[1;32m==> {name}\033[0m')
+        start = time.monotonic()
+        try:
+            with TRACER.span('phase ' + name):
+                phase(state, options)
+        except BaseException:
+            save_state(state, state_path)
+            print(f'\033[0;31mPhase {name} failed\033[0m, fix the problem then resume with '
+                  f'"python final.py --from {name}" or clean up with "python final.py --only teardown"')
+            raise
+        if name not in state['completed']:
+            state['completed'].append(name)
+        save_state(state, state_path)
+        print(f'--> {name} completed in {time.monotonic() - start:.1f} sec')
+
+
+def print_critical_path(tracer, min_share=0.01):
+    """
+    Prints the critical path of the run, leaving out the spans shorter than {min_share} of the run
+    """
+    path = tracer.critical_path()
+    if not path:
+        return
+    total = path[0][1]['end'] - path[0][1]['start']
+    print('Critical path:')
+    for depth, span in path:
+        duration = span['end'] - span['start']
+        if duration < min_share * total:
+            continue
+        attributes = ', '.join(f'{key}={value}' for key, value in span['attributes'].items())
+        print('%8.1f sec  %s%s' % (duration, '  ' * depth, span['name']) + (f' ({attributes})' if attributes else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Deploys two clusters behind an application load balancer, load tests them and reports '
+                    'their CloudWatch metrics. Completed phases are recorded in a state file and skipped '
+                    'when the script is run again.')
+    parser.add_argument('--state', default=STATE_PATH, help='state file (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true', help='forget the saved state and start a new deployment')
+    parser.add_argument('--from', dest='from_phase', choices=PHASE_NAMES,
+                        help='run this phase and every following one, even if they already completed')
+    parser.add_argument('--only', nargs='+', choices=PHASE_NAMES, help='only run these phases')
+    parser.add_argument('--skip', nargs='+', choices=PHASE_NAMES, default=[], help='never run these phases')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='requests in flight per scenario (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=LOAD_PROCESSES,
+                        help='processes generating the load (default: %(default)s)')
+    parser.add_argument('--rebuild-bundle', action='store_true',
+                        help='download the wheels and the app sources again instead of using the cached bundle')
+    parser.add_argument('--telemetry-port', type=int, default=TELEMETRY_PORT,
+                        help='local port serving the live telemetry of the load test, 0 to disable it '
+                             '(default: %(default)s)')
+    parser.add_argument('--telemetry-host', default=TELEMETRY_HOST,
+                        help='address the live telemetry listens on, 0.0.0.0 to reach it from outside a container '
+                             '(default: %(default)s)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='benchmark the load generator against local stand-ins instead of AWS')
+    parser.add_argument('--update-baseline', action='store_true', help='record the benchmark as the new baseline')
+    parser.add_argument('--sweep', metavar='MATRIX',
+                        help='provision and load test every configuration of a JSON sweep matrix instead of '
+                             'the two clusters, and compare their throughput per dollar')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='record the timing of every phase, AWS call, bootstrap step and scenario to FILE, '
+                             'as a Chrome trace if it ends with .json, as JSON lines otherwise')
+    options = parser.parse_args(argv)
+
+    if options.trace:
+        TRACER.enabled = True
+    try:
+        with TRACER.span('run', argv=sys.argv[1:] if argv is None else list(argv)):
+            run(options)
+    finally:
+        if options.trace:
+            TRACER.export(options.trace)
+            print_critical_path(TRACER)
+            print(f'--> Trace written to {options.trace}')
+
+
+def run(options):
+    if options.sweep:
+        sweep(options.sweep, options)
+        return
+    if options.benchmark:
+        if not benchmark(update_baseline=options.update_baseline, concurrency=options.concurrency,
+                         processes=options.processes):
+            sys.exit(1)
+        return
+
+    state = {'completed': []} if options.restart else load_state(options.state)
+    if options.only:
+        names = options.only
+    elif options.from_phase:
+        names = PHASE_NAMES[PHASE_NAMES.index(options.from_phase):]
+    else:
+        names = [name for name in PHASE_NAMES if name not in state['completed']]
+    names = [name for name in names if name not in options.skip]
+    if not names:
+        print('Every phase already completed, see --restart, --from and --only')
+        return
+    run_phases(names, state, options, options.state)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 #/bin/bash
 
 docker build -t tp1-docker --secret id=aws,src=$HOME/.aws/credentials .
-docker run tp1-docker
+# the work directory keeps the state of the deployment between runs, the arguments go to final.py
+mkdir -p work
+# the live telemetry of the load test is published on the loopback address of the host only
+docker run --rm -v "$PWD/work:/work" -p 127.0.0.1:8089:8089 tp1-docker "$@"
@@ -0,0 +1,624 @@
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+import boto3
+import numpy as np
+from botocore.exceptions import ClientError, WaiterError
+from botocore.stub import ANY, Stubber
+
+import final
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+
+def stubbed_client(service):
+    """
+    Returns a client whose calls are answered by a botocore Stubber instead of AWS
+    """
+    client = boto3.client(service, region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+    return client, Stubber(client)
+
+
+def run_instances_response(*instance_ids, instance_type='t2.micro'):
+    return {'Instances': [{'InstanceId': instance_id, 'InstanceType': instance_type} for instance_id in instance_ids]}
+
+
+def describe_instances_response(*states):
+    return {'Reservations': [{'Instances': [{'InstanceId': instance_id, 'State': {'Name': state}}
+                                            for instance_id, state in states]}]}
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = final.Tracer()
+        self.tracer.enabled = True
+
+    def span(self, name, start, end, parent=None):
+        span_id = self.tracer._new_id()
+        self.tracer._record(span_id, name, parent, start, end, {})
+        return span_id
+
+    def names(self, spans):
+        return [span['name'] for span in spans]
+
+    def test_nested_spans(self):
+        def threaded():
+            with self.tracer.span('threaded'):
+                pass
+
+        with self.assertRaises(ValueError):
+            with self.tracer.span('outer'):
+                with ThreadPoolExecutor() as executor:
+                    executor.submit(self.tracer.wrap(threaded)).result()
+                with self.tracer.span('inner', step=1):
+                    raise ValueError('boom')
+        spans = {span['name']: span for span in self.tracer.spans}
+        self.assertEqual(spans['threaded']['parent'], spans['outer']['id'])
+        self.assertEqual(spans['inner']['parent'], spans['outer']['id'])
+        self.assertEqual(spans['inner']['attributes'], {'step': 1})
+        self.assertEqual(spans['inner']['error'], 'ValueError: boom')
+        self.assertEqual(spans['outer']['error'], 'ValueError: boom')
+
+    def test_disabled_tracer_records_nothing(self):
+        self.tracer.enabled = False
+        with self.tracer.span('outer'):
+            pass
+        self.assertEqual(self.tracer.spans, [])
+
+    def test_critical_path(self):
+        root = self.span('run', 0, 10)
+        self.span('provision', 0, 4, root)
+        self.span('overlapped', 1, 3, root)
+        test = self.span('test', 4, 10, root)
+        self.span('scenario', 5, 9, test)
+        path = self.tracer.critical_path()
+        self.assertEqual([(depth, span['name']) for depth, span in path],
+                         [(0, 'run'), (1, 'provision'), (1, 'test'), (2, 'scenario')])
+
+    def test_adopt(self):
+        worker = final.Tracer()
+        worker.enabled = True
+        with worker.span('load shard'):
+            with worker.span('scenario'):
+                pass
+        with self.tracer.span('load test'):
+            self.tracer.adopt(worker.spans)
+        spans = {span['name']: span for span in self.tracer.spans}
+        self.assertEqual(len({span['id'] for span in self.tracer.spans}), 3)
+        self.assertEqual(spans['load shard']['parent'], spans['load test']['id'])
+        self.assertEqual(spans['scenario']['parent'], spans['load shard']['id'])
+
+
+class TestAWSCallSpans(unittest.TestCase):
+
+    def setUp(self):
+        final.TRACER.reset(True)
+        self.addCleanup(final.TRACER.reset, False)
+        # a region of its own, the shared clients of the other tests are left alone
+        self.ec2 = final.aws_client('ec2', 'eu-west-3')
+        self.stubber = Stubber(self.ec2)
+
+    def test_calls_are_recorded_as_children_of_the_current_span(self):
+        self.stubber.add_response('describe_instances', describe_instances_response(('i-1', 'running')),
+                                  {'InstanceIds': ['i-1']})
+        with self.stubber, final.TRACER.span('provision'):
+            self.ec2.describe_instances(InstanceIds=['i-1'])
+        spans = {span['name']: span for span in final.TRACER.spans}
+        call = spans['aws ec2.DescribeInstances']
+        self.assertEqual(call['parent'], spans['provision']['id'])
+        self.assertEqual(call['attributes']['instance_ids'], ['i-1'])
+        self.assertIsNone(call['error'])
+
+    def test_failed_calls_keep_their_error(self):
+        self.stubber.add_client_error('describe_instances', 'InvalidInstanceID.NotFound')
+        with self.stubber, self.assertRaises(ClientError):
+            self.ec2.describe_instances(InstanceIds=['i-1'])
+        self.assertEqual(final.TRACER.spans[0]['error'], 'InvalidInstanceID.NotFound')
+
+    def test_hooks_never_raise(self):
+        # after-call-error gives no response, and the events may come without a model
+        final.TRACER.before_aws_call(params={}, model=None, context={})
+        final.TRACER.after_aws_call(context={'trace': None}, exception=OSError('connection reset'))
+        final.TRACER.after_aws_call(context=None)
+        self.assertEqual(final.TRACER.spans, [])
+
+
+
+@mock.patch('builtins.print', mock.Mock())
+class TestProvisioning(unittest.TestCase):
+
+    def test_wait_for_instances_polls_until_running(self):
+        ec2, stubber = stubbed_client('ec2')
+        stubber.add_response('describe_instances', describe_instances_response(('i-1', 'pending'), ('i-2', 'running')),
+                             {'InstanceIds': ['i-1', 'i-2']})
+        stubber.add_response('describe_instances', describe_instances_response(('i-1', 'running'), ('i-2', 'running')),
+                             {'InstanceIds': ['i-1', 'i-2']})
+        with stubber:
+            final.wait_for_instances(['i-1', 'i-2'], ec2, delay=0)
+        stubber.assert_no_pending_responses()
+
+    def test_wait_for_instances_fails_on_terminated_instance(self):
+        ec2, stubber = stubbed_client('ec2')
+        stubber.add_response('describe_instances', describe_instances_response(('i-1', 'terminated')),
+                             {'InstanceIds': ['i-1']})
+        with stubber, self.assertRaises(WaiterError):
+            final.wait_for_instances(['i-1'], ec2, delay=0)
+
+    def test_create_clusters_waits_for_every_cluster_at_once(self):
+        ec2, stubber = stubbed_client('ec2')
+        stubber.add_response('run_instances', run_instances_response('i-1', 'i-2'))
+        stubber.add_response('run_instances', run_instances_response('i-3'))
+        stubber.add_response('describe_instances',
+                             describe_instances_response(('i-1', 'running'), ('i-2', 'running'), ('i-3', 'running')),
+                             {'InstanceIds': ANY})
+        launched = mock.Mock()
+        with stubber, mock.patch.object(final, 'wait_for_instances', wraps=final.wait_for_instances) as wait:
+            clusters = final.create_clusters({'cluster1': ('t2.micro', 2), 'cluster2': ('t2.micro', 1)}, ec2,
+                                             launched=launched)
+        stubber.assert_no_pending_responses()
+        self.assertEqual(set(clusters), {'cluster1', 'cluster2'})
+        self.assertEqual(wait.call_count, 1)
+        self.assertEqual(sorted(wait.call_args[0][0]), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(sorted(call[0][0] for call in launched.call_args_list), ['cluster1', 'cluster2'])
+
+    def test_create_clusters_reports_launched_clusters_before_raising(self):
+        ec2, stubber = stubbed_client('ec2')
+        stubber.add_response('run_instances', run_instances_response('i-1'))
+        stubber.add_client_error('run_instances', 'InstanceLimitExceeded')
+        launched = mock.Mock()
+        with stubber, self.assertRaises(ClientError):
+            final.create_clusters({'cluster1': ('t2.micro', 1), 'cluster2': ('t2.micro', 1)}, ec2, launched=launched)
+        self.assertEqual(launched.call_count, 1)
+        self.assertEqual(launched.call_args[0][1], run_instances_response('i-1'))
+        # no waiter call was stubbed: the failed launch is raised before waiting
+        stubber.assert_no_pending_responses()
+
+    def test_create_clusters_without_wait(self):
+        ec2, stubber = stubbed_client('ec2')
+        stubber.add_response('run_instances', run_instances_response('i-1'))
+        with stubber:
+            clusters = final.create_clusters({'cluster1': ('t2.micro', 1)}, ec2, wait=False)
+        self.assertEqual(clusters, {'cluster1': run_instances_response('i-1')})
+
+
+
+def target_group(name):
+    return {'TargetGroups': [{'TargetGroupArn': f'arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/{name}/1'}]}
+
+
+def target_health_response(*states):
+    return {'TargetHealthDescriptions': [{'Target': {'Id': instance_id}, 'TargetHealth': {'State': state}}
+                                         for instance_id, state in states]}
+
+
+@mock.patch('builtins.print', mock.Mock())
+class TestWaitForHealthyTargets(unittest.TestCase):
+
+    def test_polls_every_target_group_until_healthy(self):
+        elbv2, stubber = stubbed_client('elbv2')
+        target_groups = {'cluster1': target_group('cluster1'), 'cluster2': target_group('cluster2')}
+        # one poll of both target groups while i-1 is still starting, then a poll with every target healthy
+        for cluster, instance_id, state in [('cluster1', 'i-1', 'initial'), ('cluster2', 'i-2', 'healthy'),
+                                            ('cluster1', 'i-1', 'healthy'), ('cluster2', 'i-2', 'healthy')]:
+            stubber.add_response('describe_target_health', target_health_response((instance_id, state)),
+                                 {'TargetGroupArn': target_groups[cluster]['TargetGroups'][0]['TargetGroupArn']})
+        with stubber:
+            final.wait_for_healthy_targets(target_groups, timeout=10, elbv2_client=elbv2, base_delay=0)
+        stubber.assert_no_pending_responses()
+
+    def test_times_out_without_registered_targets(self):
+        elbv2, stubber = stubbed_client('elbv2')
+        stubber.add_response('describe_target_health', target_health_response())
+        with stubber, self.assertRaises(TimeoutError):
+            final.wait_for_healthy_targets({'cluster1': target_group('cluster1')}, timeout=0.5, elbv2_client=elbv2,
+                                           base_delay=1)
+
+
+class TestTimeSeries(unittest.TestCase):
+
+    def test_resample(self):
+        series = final.TimeSeries([0, 1, 2, 3, 6], [1, 2, np.nan, 4, 8])
+        resampled = series.resample(2)
+        np.testing.assert_array_equal(resampled.times, [0, 2, 4, 6])
+        np.testing.assert_array_equal(resampled.values, [1.5, 4, np.nan, 8])
+        np.testing.assert_array_equal(series.resample(2, how='sum').values, [3, 4, np.nan, 8])
+        np.testing.assert_array_equal(series.resample(2, how='max').values, [2, 4, np.nan, 8])
+        with self.assertRaises(ValueError):
+            series.resample(2, how='median')
+
+    def test_align(self):
+        first = final.TimeSeries([0, 60, 120], [1, 2, 3])
+        second = final.TimeSeries([30, 90, 150, 210], [10, 20, 30, 40])
+        aligned = final.TimeSeries.align(first, second)
+        for series in aligned:
+            np.testing.assert_array_equal(series.times, [0, 60, 120, 180])
+        np.testing.assert_array_equal(aligned[0].values, [1, 2, 3, np.nan])
+        np.testing.assert_array_equal(aligned[1].values, [10, 20, 30, 40])
+
+    def test_align_empty(self):
+        aligned = final.TimeSeries.align(final.TimeSeries([], []), final.TimeSeries([], []))
+        self.assertEqual([len(series) for series in aligned], [0, 0])
+
+class TestMetricsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = final.MetricsCache(':memory:')
+        self.addCleanup(self.cache.close)
+
+    def test_missing_ranges(self):
+        self.assertEqual(self.cache.missing('key', 0, 100), [(0, 100)])
+        self.cache.store('key', [], 10, 20)
+        self.cache.store('key', [], 30, 40)
+        self.assertEqual(self.cache.missing('key', 0, 50), [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(self.cache.missing('key', 12, 18), [])
+        self.assertEqual(self.cache.missing('other', 12, 18), [(12, 18)])
+
+    def test_touching_ranges_are_merged(self):
+        self.cache.store('key', [], 10, 20)
+        self.cache.store('key', [], 30, 40)
+        self.cache.store('key', [], 20, 30)
+        self.assertEqual(self.cache.db.execute('SELECT start, end FROM ranges').fetchall(), [(10, 40)])
+        self.assertEqual(self.cache.missing('key', 0, 50), [(0, 10), (40, 50)])
+
+    def test_store_and_load(self):
+        self.cache.store('key', [(10, 1.0), (20, 2.0), (30, 3.0)], 0, 60)
+        self.cache.store('key', [(20, 5.0)])
+        self.assertEqual(self.cache.load('key', 15, 40), [(20, 5.0), (30, 3.0)])
+        self.assertEqual(self.cache.missing('key', 0, 60), [])
+
+    def test_fetch_metrics_only_asks_for_missing_ranges(self):
+        cloudwatch = FakeCloudWatch()
+        with mock.patch.object(final, 'METRICS_CACHE_LAG', 0):
+            final.fetch_metrics(metric_specs(1), 0, 600, 60, cloudwatch, self.cache)
+            series = final.fetch_metrics(metric_specs(1), 300, 900, 60, cloudwatch, self.cache)
+        self.assertEqual([(call['StartTime'].timestamp(), call['EndTime'].timestamp()) for call in cloudwatch.calls],
+                         [(0, 600), (600, 900)])
+        # the datapoint at 600 comes from the second call, nothing was fetched twice
+        np.testing.assert_array_equal(series['metric0'].values, [np.nan] * 5 + [0.0] + [np.nan] * 4)
+
+class FakeCloudWatch:
+    """
+    CloudWatch client answering GetMetricData with one datapoint per query and page, a period apart
+    """
+
+    def __init__(self, pages=1):
+        self.pages = pages
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_metric_data(self, **kwargs):
+        with self.lock:
+            self.calls.append(kwargs)
+        page = int(kwargs.get('NextToken', 0))
+        response = {'MetricDataResults': [{'Id': query['Id'], 'Values': [float(page)],
+                                           'Timestamps': [kwargs['StartTime'] + timedelta(seconds=60 * page)]}
+                                          for query in kwargs['MetricDataQueries']]}
+        if page + 1 < self.pages:
+            response['NextToken'] = str(page + 1)
+        return response
+
+
+def metric_specs(count):
+    return [final.MetricSpec(f'metric{index}', 'RequestCount', (('LoadBalancer', 'app/lb/1'),), 'Sum')
+            for index in range(count)]
+
+
+class TestFetchMetrics(unittest.TestCase):
+
+    def test_specs_are_split_in_calls_of_at_most_max_queries(self):
+        cloudwatch = FakeCloudWatch()
+        with mock.patch.object(final, 'MAX_METRIC_QUERIES', 2):
+            series = final.fetch_metrics(metric_specs(5), 0, 600, period=60, cloudwatch_client=cloudwatch)
+        self.assertEqual(sorted(len(call['MetricDataQueries']) for call in cloudwatch.calls), [1, 2, 2])
+        for metric in series.values():
+            np.testing.assert_array_equal(metric.times, np.arange(0, 600, 60))
+            self.assertEqual(metric.values[0], 0.0)
+            self.assertTrue(np.isnan(metric.values[1:]).all())
+
+    def test_calls_stay_under_max_datapoints(self):
+        cloudwatch = FakeCloudWatch()
+        # 10 periods per series, a call may only return 20 datapoints
+        with mock.patch.object(final, 'MAX_METRIC_DATAPOINTS', 20):
+            final.fetch_metrics(metric_specs(5), 0, 600, period=60, cloudwatch_client=cloudwatch)
+        self.assertEqual(sorted(len(call['MetricDataQueries']) for call in cloudwatch.calls), [1, 2, 2])
+
+    def test_pages_are_followed(self):
+        cloudwatch = FakeCloudWatch(pages=3)
+        series = final.fetch_metrics(metric_specs(1), 0, 600, period=60, cloudwatch_client=cloudwatch)
+        self.assertEqual([call.get('NextToken') for call in cloudwatch.calls], [None, '1', '2'])
+        np.testing.assert_array_equal(series['metric0'].values[:4], [0, 1, 2, np.nan])
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(final.LatencyHistogram().percentile(99), 0.0)
+
+    def test_percentiles_within_one_percent(self):
+        histogram = final.LatencyHistogram()
+        for millisecond in range(1, 1001):
+            histogram.record(millisecond / 1000)
+        self.assertEqual(histogram.total, 1000)
+        for percent in (50, 90, 99):
+            self.assertAlmostEqual(histogram.percentile(percent), percent / 100, delta=percent / 100 * 0.01)
+        self.assertEqual(histogram.percentile(100), 1.0)
+
+    def test_small_values_are_exact(self):
+        histogram = final.LatencyHistogram()
+        for microseconds in (3, 7, 100):
+            histogram.record(microseconds / 1e6)
+        self.assertEqual(histogram.percentile(50), 7 / 1e6)
+
+    def test_merge(self):
+        first, second = final.LatencyHistogram(), final.LatencyHistogram()
+        for latency in (0.01, 0.02):
+            first.record(latency)
+        second.record(2.0)
+        first.merge(second)
+        self.assertEqual(first.total, 3)
+        self.assertEqual(first.percentile(100), 2.0)
+        self.assertAlmostEqual(first.percentile(50), 0.02, delta=0.0002)
+
+class TestTargetStats(unittest.TestCase):
+
+    @staticmethod
+    def stats(*responses):
+        stats = final.TargetStats()
+        for instance, latency in responses:
+            stats.record('cluster1', instance, 200, latency)
+        return stats
+
+    def test_even_round_robin_is_not_flagged(self):
+        self.assertEqual(self.stats(*[('i-1', 0.01), ('i-2', 0.01)] * 50).flags('cluster1', expected=2), [])
+
+    def test_imbalance_and_missing_targets(self):
+        flags = self.stats(*[('i-1', 0.01)] * 90 + [('i-2', 0.01)] * 10).flags('cluster1', expected=3)
+        self.assertIn('only 2 of 3 targets served requests', flags)
+        self.assertIn('imbalance: i-1 served 90% of the requests, expected 33%', flags)
+
+    def test_sticky_routing(self):
+        stats = self.stats(*[('i-1', 0.01)] * 50 + [('i-2', 0.01)] * 50)
+        self.assertIn('sticky routing: 99% of consecutive responses came from the same target', stats.flags('cluster1'))
+        # consecutive responses of a shard are not consecutive responses of the load balancer
+        stats.merge(final.TargetStats())
+        self.assertEqual(stats.flags('cluster1'), [])
+
+    def test_slow_target(self):
+        stats = self.stats(*[('i-1', 0.01), ('i-2', 0.01), ('i-3', 0.05)] * 20)
+        self.assertEqual(stats.flags('cluster1'), ['slow target: i-3 p50 is 5.0x the cluster median'])
+
+    def test_unidentified_responses_are_not_flagged_as_imbalance(self):
+        self.assertEqual(final.served_by({'message': 'hello'}), final.UNKNOWN_INSTANCE)
+        self.assertEqual(final.served_by({'instance_id': 'i-1'}), 'i-1')
+        flags = self.stats(*[(final.UNKNOWN_INSTANCE, 0.01)] * 100).flags('cluster1', expected=2)
+        self.assertEqual(flags, ['responses do not identify their instance (100 requests), '
+                                 'the distribution between targets is not checked'])
+
+
+
+
+
+def result(status=200, latency=0.01):
+    return final.RequestResult(0, 'cluster1', latency, status, 'i-1')
+
+
+class TestLiveTelemetry(unittest.TestCase):
+
+    def test_drain_returns_every_ended_second_once(self):
+        telemetry = final.LiveTelemetry()
+        with mock.patch('time.time', return_value=100.5):
+            telemetry.scheduled('cluster1')
+            telemetry.scheduled('cluster1')
+            telemetry.started('cluster1')
+            telemetry.record(result())
+        with mock.patch('time.time', return_value=101.2):
+            buckets, in_flight, queued = telemetry.drain()
+            self.assertEqual([bucket[:4] for bucket in buckets], [('cluster1', 100, 1, 0)])
+            self.assertEqual((in_flight, queued), ({'cluster1': 0}, {'cluster1': 1}))
+            self.assertEqual(telemetry.drain()[0], [])
+            telemetry.started('cluster1')
+            telemetry.record(result(status=503))
+            # the current second only ends with the test
+            self.assertEqual(telemetry.drain()[0], [])
+            buckets, in_flight, queued = telemetry.drain(final=True)
+            self.assertEqual([bucket[:4] for bucket in buckets], [('cluster1', 101, 1, 1)])
+            self.assertEqual((in_flight, queued), ({'cluster1': 0}, {'cluster1': 0}))
+
+    def test_merge_adds_the_drained_buckets_of_every_worker(self):
+        telemetry = final.LiveTelemetry()
+        workers = [final.LiveTelemetry(), final.LiveTelemetry()]
+        for latency, worker in zip((0.01, 0.1), workers):
+            with mock.patch('time.time', return_value=100.5):
+                worker.scheduled('cluster1')
+                worker.started('cluster1')
+                worker.scheduled('cluster1')
+                worker.started('cluster1')
+                worker.record(result(latency=latency))
+            with mock.patch('time.time', return_value=101.2):
+                telemetry.merge(workers.index(worker), *worker.drain())
+        with mock.patch('time.time', return_value=101.2):
+            snapshot = telemetry.snapshot()['clusters']['cluster1']
+        self.assertEqual((snapshot['total'], snapshot['throughput'], snapshot['in_flight']), (2, 2.0, 2))
+        self.assertAlmostEqual(snapshot['max_latency'], 0.1)
+        # the requests in flight of a worker are replaced by its latest count, not added up
+        telemetry.merge(0, [], {'cluster1': 0}, {'cluster1': 0})
+        with mock.patch('time.time', return_value=101.2):
+            self.assertEqual(telemetry.snapshot()['clusters']['cluster1']['in_flight'], 1)
+
+
+
+class TestLoadProfile(unittest.TestCase):
+
+    def test_counts(self):
+        self.assertEqual(final.LoadProfile.constant(rate=20, duration=10).count, 200)
+        self.assertEqual(final.LoadProfile.ramp(start_rate=0, end_rate=50, duration=20).count, 500)
+        self.assertEqual(final.LoadProfile.step([10, 20], step_duration=5).count, 150)
+        self.assertEqual(final.LoadProfile.spike(10, 100, duration=10, spike_start=4, spike_duration=2).count, 280)
+
+    def test_send_times_follow_the_rate(self):
+        profile = final.LoadProfile.ramp(start_rate=0, end_rate=50, duration=20)
+        times = list(profile.send_times())
+        self.assertEqual(times, sorted(times))
+        self.assertTrue(0 <= times[0] and times[-1] < profile.duration)
+        # a linear ramp sends a quarter of its requests in its first half
+        self.assertEqual(sum(1 for t in times if t < 10), 125)
+
+    def test_constant_spacing(self):
+        times = list(final.LoadProfile.constant(rate=4, duration=1).send_times())
+        self.assertEqual(times, [0.0, 0.25, 0.5, 0.75])
+
+class TestSaturationPoint(unittest.TestCase):
+
+    def test_first_saturated_window(self):
+        # 10, 20 then 30 req/s over 10 s windows, latency goes over the SLO in the last window
+        timestamps = np.concatenate([np.arange(0, 10, 0.1), np.arange(10, 20, 0.05), np.arange(20, 30, 1 / 30)])
+        latencies = np.where(timestamps < 20, 0.05, final.SWEEP_LATENCY_SLO * 2)
+        statuses = np.full(len(timestamps), 200)
+        windows, sustained, saturation = final.saturation_point(timestamps, latencies, statuses, duration=30,
+                                                                 window=10)
+        self.assertEqual([w['saturated'] for w in windows], [False, False, True])
+        self.assertAlmostEqual(sustained, 20)
+        self.assertAlmostEqual(saturation, 30)
+
+    def test_errors_saturate(self):
+        timestamps = np.arange(0, 20, 0.1)
+        latencies = np.full(len(timestamps), 0.05)
+        statuses = np.where(timestamps < 10, 200, 503)
+        statuses[-1] = 0
+        windows, sustained, saturation = final.saturation_point(timestamps, latencies, statuses, duration=20,
+                                                                 window=10)
+        self.assertEqual(windows[1]['error_rate'], 1.0)
+        self.assertAlmostEqual(sustained, 10)
+        self.assertAlmostEqual(saturation, 10)
+
+    def test_no_requests(self):
+        self.assertEqual(final.saturation_point(np.array([]), np.array([]), np.array([]), duration=10),
+                         ([], 0.0, None))
+
+class LocalSSHServer:
+    """
+    SSH server on 127.0.0.1 accepting any public key and running every command locally with sh
+    """
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.negotiate, args=(connection,), daemon=True).start()
+
+    def negotiate(self, connection):
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=self.Interface())
+        except (paramiko.SSHException, EOFError):
+            pass  # wait_for_port probes the port without speaking SSH
+
+    def close(self):
+        self.listener.close()
+
+    class Interface(paramiko.ServerInterface if paramiko else object):
+
+        def get_allowed_auths(self, username):
+            return 'publickey'
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED
+
+        def check_channel_exec_request(self, channel, command):
+            def runCommand():
+                process = subprocess.run(command.decode(), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                try:
+                    channel.sendall(process.stdout)
+                    channel.sendall_stderr(process.stderr)
+                    channel.send_exit_status(process.returncode)
+                    channel.close()
+                except (EOFError, OSError):
+                    pass  # the last command is only launched, the client may be gone when it ends
+
+            threading.Thread(target=runCommand, daemon=True).start()
+            return True
+
+
+@unittest.skipIf(paramiko is None, 'paramiko is not installed')
+class TestRunSSHCommands(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.key_filename = os.path.join(cls.directory.name, 'key.pem')
+        paramiko.RSAKey.generate(2048).write_private_key_file(cls.key_filename)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.directory.cleanup()
+
+    def run_commands(self, commands):
+        return final.run_ssh_commands('127.0.0.1', commands, port=self.server.port, username='test',
+                                      key_filename=self.key_filename)
+
+    def test_runs_every_command(self):
+        path = shlex.quote(os.path.join(self.directory.name, 'steps'))
+        commands = [f'echo one >> {path}', f'echo two >> {path}', f'echo started >> {path}']
+        result = self.run_commands(commands)
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(list(result.timings), ['wait for ssh', 'connect'] + commands)
+        # the last command is only launched, not waited for
+        for _ in range(50):
+            with open(os.path.join(self.directory.name, 'steps')) as steps:
+                if steps.read().split() == ['one', 'two', 'started']:
+                    return
+            time.sleep(0.1)
+        self.fail('the last command did not run')
+
+    def test_stops_at_the_first_failing_command(self):
+        path = shlex.quote(os.path.join(self.directory.name, 'never'))
+        result = self.run_commands(['true', 'echo boom >&2; exit 3', f'touch {path}', 'true'])
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error, '"echo boom >&2; exit 3" exited with 3: boom')
+        self.assertNotIn(f'touch {path}', result.timings)
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, 'never')))
+
+    def test_reports_the_failing_step(self):
+        with mock.patch.object(final, 'SSH_READY_TIMEOUT', 1):
+            result = final.run_ssh_commands('127.0.0.1', ['true'], port=self.unused_port(),
+                                            key_filename=self.key_filename)
+        self.assertFalse(result.ok)
+        self.assertTrue(result.error.startswith('wait for ssh: '), result.error)
+
+    @staticmethod
+    def unused_port():
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            return listener.getsockname()[1]
+
+
+if __name__ == '__main__':
+    unittest.main()